@@ -1,28 +1,75 @@
 import asyncio
-import json
+import hashlib
+import logging
 import os
-import sqlite3
+import time
 import uuid
 
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
 
-from anthropic import Anthropic
-from anthropic.types import (
-    Message,
-    TextBlock,
-    ToolUseBlock,
-)
-from anthropic.types.beta import BetaTextBlock
+import aiosqlite
+import httpx
+import orjson
+import zstandard as zstd
+
+# The Anthropic SDK is slow to import and only needed once an agent is built
+if TYPE_CHECKING:
+    from anthropic import AsyncAnthropic
+    from anthropic.types import Message
 
 from .config import (
+    BATCH_THRESHOLD,
     CLAUDE_API_KEY,
     CLAUDE_MAX_TOKENS,
     CLAUDE_MODEL,
+    KEEP_RECENT_TURNS,
+    LAZY_TOOL_SCHEMAS,
+    MAX_CONCURRENT_TOOLS,
+    MAX_HISTORY_TOKENS,
+    MCP_SERVER_URLS,
+    MCP_TOOL_CACHE_TTL,
     REQUEST_TIMEOUT,
 )
+from .media import SUPPORTED_MEDIA_TYPE
+
+# Defined here before claude.media existed; still importable from here
+from .media import claude_image_block, claude_image_block_from_bytes  # noqa: F401
+from .tools import INLINE_TOOLS, LOCAL_TOOLS, MUTATING_TOOLS, execute_local_tool
+
+logger = logging.getLogger(__name__)
+
+try:
+    import uvloop
+
+    _new_event_loop = uvloop.new_event_loop
+except ImportError:
+    _new_event_loop = asyncio.new_event_loop
+
+try:
+    import h2  # noqa: F401 - httpx needs it for HTTP/2
+
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+# Concurrent turns and tool round trips share one pool per client; the httpx
+# defaults (100 connections, 20 kept alive) are hit well before the network is
+HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+
+
+def _anthropic_client(config: "Config") -> "AsyncAnthropic":
+    """Async Anthropic client on a larger, HTTP/2-capable connection pool"""
+    from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+
+    return AsyncAnthropic(
+        api_key=config.claude_api_key,
+        timeout=config.request_timeout,
+        http_client=DefaultAsyncHttpxClient(limits=HTTP_LIMITS, http2=_HTTP2),
+    )
 
-from .tools import LOCAL_TOOLS, execute_local_tool
 
 DATA_PATH = os.environ["DB_PATH"]
 DB_PATH = os.path.join(DATA_PATH, "claude_conversation.db")
@@ -37,11 +84,25 @@ class Config:
         claude_model: str = CLAUDE_MODEL,
         claude_max_tokens: int = CLAUDE_MAX_TOKENS,
         request_timeout: int = REQUEST_TIMEOUT,
+        mcp_server_urls: Sequence[str] = MCP_SERVER_URLS,
+        max_concurrent_tools: int = MAX_CONCURRENT_TOOLS,
+        max_history_tokens: int = MAX_HISTORY_TOKENS,
+        keep_recent_turns: int = KEEP_RECENT_TURNS,
+        lazy_tool_schemas: bool = LAZY_TOOL_SCHEMAS,
+        mcp_tool_cache_ttl: float = MCP_TOOL_CACHE_TTL,
+        batch_threshold: int = BATCH_THRESHOLD,
     ):
         self.claude_api_key = claude_api_key
         self.claude_model = claude_model
         self.claude_max_tokens = claude_max_tokens
         self.request_timeout = request_timeout
+        self.mcp_server_urls = mcp_server_urls
+        self.max_concurrent_tools = max_concurrent_tools
+        self.max_history_tokens = max_history_tokens
+        self.keep_recent_turns = keep_recent_turns
+        self.lazy_tool_schemas = lazy_tool_schemas
+        self.mcp_tool_cache_ttl = mcp_tool_cache_ttl
+        self.batch_threshold = batch_threshold
 
 
 class DummyAgent:
@@ -67,10 +128,18 @@ class DummyAgent:
 STRUCTURED_OUTPUT_HEADER = "structured-outputs-2025-11-13"
 
 
+RESPONSE_CACHE_SIZE = 128
+
+# Upper bound on the backoff between Message Batches status polls, in seconds
+BATCH_POLL_MAX_DELAY = 60
+
+
 class ClaudeSimpleBetaAgent:
     def __init__(self, config: Config):
         self.config = config
-        self.client = Anthropic(api_key=config.claude_api_key)
+        self.client = _anthropic_client(config)
+        # Exact-match LRU of request hash -> response text
+        self._cache: OrderedDict[str, str] = OrderedDict()
 
     async def initialize(self) -> None:
         pass
@@ -87,10 +156,19 @@ class ClaudeSimpleBetaAgent:
         Args:
             conversation_history: list of messages
             system_prompt: Optional system prompt to guide Claude's behavior
+            no_cache: Skip the response cache and always call the API
 
         Returns:
             Claude's final response as a string
         """
+        no_cache = kwargs.pop("no_cache", False)
+
+        # Copy so the caller's list is never mutated, and keep it out of
+        # api_params so it is only passed once
+        betas = list(kwargs.pop("betas", ()))
+        if kwargs.get("output_format") and STRUCTURED_OUTPUT_HEADER not in betas:
+            betas.append(STRUCTURED_OUTPUT_HEADER)
+
         # Prepare the API call
         api_params = {**kwargs}
 
@@ -106,31 +184,248 @@ class ClaudeSimpleBetaAgent:
         if system_prompt:
             api_params["system"] = system_prompt
 
-        betas: list = kwargs.get("betas", [])
-        if kwargs.get("output_format") and STRUCTURED_OUTPUT_HEADER not in betas:
-            betas.append(STRUCTURED_OUTPUT_HEADER)
+        cache_key = None if no_cache else self._cache_key(api_params, betas)
+        response_text = self._cache.get(cache_key)
 
-        # Call Claude API
-        if betas:
-            response: Message = self.client.beta.messages.create(
-                **api_params, betas=betas
-            )
+        if response_text is not None:
+            self._cache.move_to_end(cache_key)
         else:
-            response: Message = self.client.messages.create(**api_params)
+            # Call Claude API
+            if betas:
+                response: Message = await self.client.beta.messages.create(
+                    **api_params, betas=betas
+                )
+            else:
+                response: Message = await self.client.messages.create(**api_params)
+
+            response_text = response.content[0].text
 
-        response_text = response.content[0].text
+            if cache_key is not None:
+                self._cache[cache_key] = response_text
+                if len(self._cache) > RESPONSE_CACHE_SIZE:
+                    self._cache.popitem(last=False)
 
         # Add assistant's response to history
         conversation_history.append({"role": "assistant", "content": response_text})
 
         return response_text
 
+    @staticmethod
+    def _cache_key(api_params: Dict[str, Any], betas: List[str]) -> str:
+        """Hash of everything that determines the response"""
+        payload = orjson.dumps(
+            {**api_params, "betas": betas},
+            default=str,
+            option=orjson.OPT_SORT_KEYS,
+        )
+        return hashlib.sha256(payload).hexdigest()
+
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def _previous_turn_index(conversation_history: List[Dict[str, Any]]) -> Optional[int]:
+    """Index of the last user message before the trailing (new) user messages"""
+    i = len(conversation_history)
+
+    # Skip the user messages appended for this turn
+    while i and conversation_history[i - 1]["role"] == "user":
+        i -= 1
+
+    # Walk back past the previous assistant reply to the user message before it
+    while i and conversation_history[i - 1]["role"] != "user":
+        i -= 1
+
+    return i - 1 if i else None
+
+
+def _with_cache_breakpoints(
+    conversation_history: List[Dict[str, Any]], *indices: Optional[int]
+) -> List[Dict[str, Any]]:
+    """
+    Return a shallow copy of the history with cache_control set on the last
+    content block of the messages at the given indices. The stored history is
+    left untouched so the markers never end up persisted.
+    """
+    messages = list(conversation_history)
+
+    for index in set(indices):
+        if index is None:
+            continue
+
+        message = messages[index]
+        content = message["content"]
+
+        if isinstance(content, str):
+            content = [
+                {"type": "text", "text": content, "cache_control": CACHE_CONTROL}
+            ]
+        else:
+            content = [*content[:-1], {**content[-1], "cache_control": CACHE_CONTROL}]
+
+        messages[index] = {**message, "content": content}
+
+    return messages
+
+
+def _dumps(obj: Any) -> str:
+    """
+    Compact JSON for tool inputs and results. Non-string keys are coerced
+    like the stdlib json module does instead of raising.
+    """
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def _is_tool_result_message(message: Dict[str, Any]) -> bool:
+    """Whether a message is the user reply carrying tool results"""
+    content = message["content"]
+    return (
+        message["role"] == "user"
+        and isinstance(content, list)
+        and any(
+            isinstance(block, dict) and block.get("type") == "tool_result"
+            for block in content
+        )
+    )
+
+
+# Images and documents are billed by their pixels and pages, not their base64
+# length, so each counts as a flat guess instead
+ATTACHMENT_TOKEN_ESTIMATE = 1600
+
+
+def _estimate_tokens(conversation_history: List[Dict[str, Any]]) -> int:
+    """Rough prompt size, assuming ~4 bytes of JSON per token"""
+    size = 0
+    attachments = 0
+    for message in conversation_history:
+        content = message["content"]
+        if isinstance(content, str):
+            size += len(content)
+            continue
+
+        for block in content:
+            source = block.get("source") if isinstance(block, dict) else None
+            if source and source.get("type") == "base64":
+                attachments += 1
+            else:
+                size += len(orjson.dumps(block))
+
+    return size // 4 + attachments * ATTACHMENT_TOKEN_ESTIMATE
+
+
+def _elide_old_tool_results(
+    conversation_history: List[Dict[str, Any]], keep_turns: int
+) -> List[Dict[str, Any]]:
+    """
+    Return a shallow copy of the history with the content of tool results
+    older than the last keep_turns user turns replaced by a placeholder.
+    Like the cache breakpoints this only shapes the request; the stored
+    history keeps the full results.
+    """
+    # Start of the window that is sent verbatim: the first message of the
+    # keep_turns-th most recent user turn
+    cutoff = 0
+    turns = 0
+    for i in range(len(conversation_history) - 1, -1, -1):
+        message = conversation_history[i]
+        if (
+            message["role"] == "user"
+            and not _is_tool_result_message(message)
+            and (i == 0 or conversation_history[i - 1]["role"] != "user")
+        ):
+            turns += 1
+            if turns == keep_turns:
+                cutoff = i
+                break
+
+    messages = list(conversation_history)
+
+    for i in range(cutoff):
+        if not _is_tool_result_message(messages[i]):
+            continue
+
+        messages[i] = {
+            **messages[i],
+            "content": [
+                (
+                    {
+                        **block,
+                        "content": f"[elided: {len(block['content'].encode())} bytes]",
+                    }
+                    if block.get("type") == "tool_result"
+                    and isinstance(block.get("content"), str)
+                    else block
+                )
+                for block in messages[i]["content"]
+            ],
+        }
+
+    return messages
+
+
+def _tools_wire(tools: Sequence[Dict[str, Any]]) -> Tuple[Dict[str, Any], ...]:
+    """
+    Build the immutable tools payload sent with every request. The breakpoint
+    on the last tool caches the whole tool definition block.
+    """
+    if not tools:
+        return ()
+
+    return (*tools[:-1], {**tools[-1], "cache_control": CACHE_CONTROL})
+
+
+# Tools are static, so the payload is built once and shared by every agent
+LOCAL_TOOLS_WIRE = _tools_wire(LOCAL_TOOLS)
+
+
+class _ToolOrder:
+    """
+    Keeps tool calls in the order Claude made them where it matters: reads
+    between two writes run concurrently, a write waits for every call made
+    before it, and every call waits for the last write made before it.
+    Calls register on entry, before their first await, so the order is the
+    order in which they were started.
+    """
+
+    def __init__(self):
+        self._last_write: Optional[asyncio.Future] = None
+        self._since_write: set = set()
+
+    @asynccontextmanager
+    async def turn(self, mutating: bool):
+        done = asyncio.get_running_loop().create_future()
+
+        if mutating:
+            wait_for = self._since_write
+            self._since_write = set()
+        else:
+            wait_for = set()
+            self._since_write.add(done)
+            done.add_done_callback(self._since_write.discard)
+
+        if self._last_write is not None:
+            wait_for.add(self._last_write)
+        if mutating:
+            self._last_write = done
+
+        try:
+            if wait_for:
+                await asyncio.wait(wait_for)
+            yield
+        finally:
+            done.set_result(None)
+
 
 class ClaudeAgent:
     def __init__(self, config: Config):
         self.config = config
-        self.client = Anthropic(api_key=config.claude_api_key)
-        self.tools: List[Dict[str, Any]] = LOCAL_TOOLS.copy()
+        self.client = _anthropic_client(config)
+        self.tools: Sequence[Dict[str, Any]] = LOCAL_TOOLS_WIRE
+
+        # Tool calls run concurrently, but a mutating one acts as a barrier
+        # so reads and writes see the state Claude expects
+        self._tool_order = _ToolOrder()
 
     async def initialize(self) -> None:
         pass
@@ -152,6 +447,22 @@ class ClaudeAgent:
         Returns:
             Claude's final response as a string
         """
+        # Cache everything up to the previous turn so only the new turn is prefilled
+        cache_index = _previous_turn_index(conversation_history)
+
+        # The API is stateless, so the full history is always sent. Marking the
+        # tail of every request writes the whole prefix to the cache, and the
+        # next tool round trip (or turn) only pays prefill for what it appends.
+
+        # Model, limits, system prompt and extra kwargs are built once per turn
+        base_params = self._base_params(system_prompt, kwargs)
+
+        # Estimated size of the full, unelided history, kept up to date by
+        # estimating only what each round trip appends. The history only
+        # grows, so once a turn goes over budget it stays elided.
+        history_tokens = 0
+        sent = 0
+
         # Process the conversation with potential tool use
         while True:
             # Prepare the API call
@@ -162,125 +473,326 @@ class ClaudeAgent:
             # for m in conversation_history:
             #     pp(m)
             # print("----------------")
-            api_params = {**kwargs}
+            history_tokens += _estimate_tokens(conversation_history[sent:])
+            sent = len(conversation_history)
 
-            api_params.update(
-                {
-                    "model": self.config.claude_model,
-                    "max_tokens": self.config.claude_max_tokens,
-                    "messages": conversation_history,
-                }
+            api_params = self._request_params(
+                base_params, conversation_history, cache_index, history_tokens
             )
 
-            # Add tools if available
-            if self.tools:
-                api_params["tools"] = self.tools
-
-            # Add system prompt if provided
-            if system_prompt:
-                api_params["system"] = system_prompt
-
             # Call Claude API
             if betas:
-                response: Message = self.client.beta.messages.create(
+                response: Message = await self.client.beta.messages.create(
                     **api_params, betas=betas
                 )
+                started = {}
             else:
-                response: Message = self.client.messages.create(**api_params)
-
-            # Check if Claude wants to use tools
-            tool_use_blocks = [
-                block for block in response.content if isinstance(block, ToolUseBlock)
-            ]
-
-            if not tool_use_blocks:
-                # No tool use, extract and return the text response
-                text_blocks = [
-                    block
-                    for block in response.content
-                    if isinstance(block, (TextBlock, BetaTextBlock))
-                ]
-                response_text = "\n".join(block.text for block in text_blocks)
-
-                # Add assistant's response to history
-                conversation_history.append(
-                    {"role": "assistant", "content": response_text}
-                )
+                response, started = await self._stream_response(api_params)
 
+            response_text = await self._handle_response(
+                conversation_history, response, started
+            )
+            if response_text is not None:
                 return response_text
 
-            # Execute all requested tools
-            for tool_use in tool_use_blocks:
-                print(f"\n🔧 Executing tool: {tool_use.name}")
-                print(f"   Input: {json.dumps(tool_use.input, indent=2)}")
+    async def chat_batch(
+        self,
+        conversations: List[List[Dict[str, Any]]],
+        system_prompt: Optional[str] = None,
+    ) -> List[str]:
+        """
+        Run the next turn of many conversations at once. From batch_threshold
+        conversations up the first request of each goes through the Message
+        Batches API, which is cheaper but asynchronous; any tool use is then
+        continued per conversation through chat().
 
-                result = execute_local_tool(tool_use.name, tool_use.input)
+        Args:
+            conversations: histories, each ending with the new user message(s)
+            system_prompt: Optional system prompt shared by every conversation
 
-                print(f"   Result: {json.dumps(result, indent=2)}")
-                conversation_history.append(
-                    {"role": "assistant", "content": [tool_use.model_dump()]}
+        Returns:
+            Claude's final response for each conversation, in order
+        """
+        if len(conversations) < self.config.batch_threshold:
+            return list(
+                await asyncio.gather(
+                    *[
+                        self.chat(conversation_history, system_prompt=system_prompt)
+                        for conversation_history in conversations
+                    ]
                 )
-                conversation_history.append(
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "tool_result",
-                                "tool_use_id": tool_use.id,
-                                "content": json.dumps(result),
-                            }
-                        ],
-                    }
+            )
+
+        base_params = self._base_params(system_prompt, {})
+        batch = await self.client.messages.batches.create(
+            requests=[
+                {
+                    "custom_id": str(i),
+                    "params": self._request_params(
+                        base_params,
+                        conversation_history,
+                        _previous_turn_index(conversation_history),
+                    ),
+                }
+                for i, conversation_history in enumerate(conversations)
+            ]
+        )
+
+        delay = 1
+        while batch.processing_status != "ended":
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_DELAY)
+            batch = await self.client.messages.batches.retrieve(batch.id)
+
+        responses: Dict[int, "Message"] = {}
+        async for entry in await self.client.messages.batches.results(batch.id):
+            if entry.result.type == "succeeded":
+                responses[int(entry.custom_id)] = entry.result.message
+
+        async def finish(i: int, conversation_history: List[Dict[str, Any]]) -> str:
+            response = responses.get(i)
+            if response is not None:
+                response_text = await self._handle_response(
+                    conversation_history, response, {}
                 )
+                if response_text is not None:
+                    return response_text
 
+            # Tool use, or a request the batch failed, carries on interactively
+            return await self.chat(conversation_history, system_prompt=system_prompt)
 
-from pathlib import Path
-from base64 import b64encode
+        return list(
+            await asyncio.gather(
+                *[
+                    finish(i, conversation_history)
+                    for i, conversation_history in enumerate(conversations)
+                ]
+            )
+        )
 
-EXT_MAP = {
-    "jpg": "image/jpeg",
-    "jpeg": "image/jpeg",
-    "png": "image/png",
-    "gif": "image/gif",
-    "webp": "image/webp",
-    "pdf": "application/pdf",
-}
+    def _base_params(
+        self, system_prompt: Optional[str], kwargs: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """The messages.create arguments that stay fixed for a whole tool loop"""
+        api_params = {
+            **kwargs,
+            "model": self.config.claude_model,
+            "max_tokens": self.config.claude_max_tokens,
+        }
 
-SUPPORTED_MEDIA_TYPE = set(EXT_MAP.values())
+        # Add system prompt if provided
+        if system_prompt:
+            api_params["system"] = [
+                {
+                    "type": "text",
+                    "text": system_prompt,
+                    "cache_control": CACHE_CONTROL,
+                }
+            ]
 
+        return api_params
 
-def claude_image_block(image_path: Path):
-    assert image_path.is_file(), f"Target not a file: {image_path}"
+    def _request_params(
+        self,
+        base_params: Dict[str, Any],
+        conversation_history: List[Dict[str, Any]],
+        cache_index: Optional[int],
+        history_tokens: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        Add the parts that change every request: messages and tools.
+        history_tokens is _estimate_tokens of the history when already known.
+        """
+        # Long sessions stop resending old tool output. This moves with each
+        # turn, so it only kicks in once the history is over budget rather
+        # than costing cache hits on every request.
+        messages = conversation_history
+        if history_tokens is None:
+            history_tokens = _estimate_tokens(messages)
+        if history_tokens > self.config.max_history_tokens:
+            messages = _elide_old_tool_results(messages, self.config.keep_recent_turns)
+
+        api_params = {
+            **base_params,
+            "messages": _with_cache_breakpoints(
+                messages,
+                cache_index,
+                len(messages) - 1,
+            ),
+        }
 
-    _, _, ext = image_path.parts[-1].rpartition(".")
-    with open(image_path, "rb") as f:
-        bytes = f.read()
+        # Add tools if available
+        tools = self._tools_for(conversation_history)
+        if tools:
+            api_params["tools"] = tools
 
-    media_type = EXT_MAP.get(ext)
-    assert media_type, f"Unrecognised ext and media_type for: {image_path}"
+        return api_params
 
-    return claude_image_block_from_bytes(ext, bytes)
+    async def _handle_response(
+        self,
+        conversation_history: List[Dict[str, Any]],
+        response: "Message",
+        started: Dict[str, asyncio.Task],
+    ) -> Optional[str]:
+        """
+        Record a response in the history, running any tools it asks for
 
+        Returns:
+            The final response text, or None if tool results were appended
+            and Claude has to be called again
+        """
+        # Split the response into tool calls and text in a single pass,
+        # keyed on the type discriminator shared by regular and beta blocks
+        tool_use_blocks = []
+        text_blocks = []
+        for block in response.content:
+            if block.type == "tool_use":
+                tool_use_blocks.append(block)
+            elif block.type == "text":
+                text_blocks.append(block)
+
+        if not tool_use_blocks:
+            # No tool use, return the text response
+            # Keep the blocks as they came; the API takes them as-is on the
+            # next request, and only the caller needs the joined text
+            content = [{"type": "text", "text": block.text} for block in text_blocks]
+
+            # Add assistant's response to history
+            conversation_history.append({"role": "assistant", "content": content or ""})
+
+            return "\n".join(block["text"] for block in content)
+
+        # Execute all requested tools concurrently
+        for tool_use in tool_use_blocks:
+            logger.info("🔧 Executing tool: %s", tool_use.name)
+            logger.debug("Input: %s", tool_use.input)
+
+        # A failing tool is reported back to Claude rather than aborting
+        # the rest of the batch
+        results = [
+            {"error": str(result)} if isinstance(result, Exception) else result
+            for result in await asyncio.gather(
+                *[
+                    started.get(tool_use.id)
+                    or self._execute_tool(tool_use.name, tool_use.input)
+                    for tool_use in tool_use_blocks
+                ],
+                return_exceptions=True,
+            )
+        ]
 
-def claude_image_block_from_bytes(ext: str, b: bytes):
-    media_type = EXT_MAP.get(ext)
-    assert media_type, f"Unrecognised ext and media_type for: {ext}"
+        # Serialize each result once; the same string is logged and sent
+        results_json = [_dumps(result) for result in results]
 
-    data = b64encode(b).decode()
+        if logger.isEnabledFor(logging.DEBUG):
+            for tool_use, result_json in zip(tool_use_blocks, results_json):
+                logger.debug("Result (%s): %s", tool_use.name, result_json)
 
-    return {
-        "role": "user",
-        "content": [
+        # All tool_use blocks belong in one assistant message, answered by
+        # one user message carrying every tool_result. The blocks are built
+        # from the fields the API reads rather than through model_dump().
+        conversation_history.append(
+            {
+                "role": "assistant",
+                "content": [
+                    {
+                        "type": "tool_use",
+                        "id": tool_use.id,
+                        "name": tool_use.name,
+                        "input": tool_use.input,
+                    }
+                    for tool_use in tool_use_blocks
+                ],
+            }
+        )
+        conversation_history.append(
             {
-                "source": {
-                    "data": data,
-                    "media_type": media_type,
-                    "type": "base64",
-                },
-                "type": "image",
+                "role": "user",
+                "content": [
+                    {
+                        "type": "tool_result",
+                        "tool_use_id": tool_use.id,
+                        "content": result_json,
+                    }
+                    for tool_use, result_json in zip(tool_use_blocks, results_json)
+                ],
             }
-        ],
-    }
+        )
+
+        return None
+
+    def _tools_for(
+        self, conversation_history: List[Dict[str, Any]]
+    ) -> Sequence[Dict[str, Any]]:
+        """Tools payload for the next request in this conversation"""
+        return self.tools
+
+    async def _stream_response(
+        self, api_params: Dict[str, Any]
+    ) -> Tuple["Message", Dict[str, asyncio.Task]]:
+        """
+        Stream a response, starting each tool call as soon as its tool_use block
+        is complete so tool I/O overlaps the rest of the generation
+
+        Returns:
+            The final message and the started tool calls keyed by tool_use id
+        """
+        started: Dict[str, asyncio.Task] = {}
+        try:
+            async with self.client.messages.stream(**api_params) as stream:
+                async for event in stream:
+                    if (
+                        event.type == "content_block_stop"
+                        and event.content_block.type == "tool_use"
+                    ):
+                        block = event.content_block
+                        started[block.id] = asyncio.create_task(
+                            self._execute_tool(block.name, block.input)
+                        )
+
+                return await stream.get_final_message(), started
+        except BaseException:
+            for task in started.values():
+                task.cancel()
+            raise
+
+    async def _execute_tool(self, tool_name: str, tool_input: Dict[str, Any]) -> Any:
+        """Execute a local tool without blocking the event loop"""
+        # A thread hop costs more than the trivial handlers themselves
+        if tool_name in INLINE_TOOLS:
+            return execute_local_tool(tool_name, tool_input)
+
+        async with self._tool_order.turn(tool_name in MUTATING_TOOLS):
+            return await asyncio.to_thread(execute_local_tool, tool_name, tool_input)
+
+
+from base64 import b64decode, b64encode
+
+
+def _user_message_content(u: str | dict[str, Any]) -> Any:
+    if not isinstance(u, dict):
+        return u
+
+    return [
+        {
+            "source": u,
+            "type": "document" if u["media_type"] == "application/pdf" else "image",
+        }
+    ]
+
+
+def _user_messages(
+    user_message: str | dict[str, Any] | list[dict[str, Any]],
+) -> List[Dict[str, Any]]:
+    """Normalise chat input into user messages, dropping unsupported attachments"""
+    if not isinstance(user_message, list):
+        user_message = [user_message]
+
+    return [
+        {"role": "user", "content": _user_message_content(u)}
+        for u in user_message
+        if not isinstance(u, dict) or u.get("media_type") in SUPPORTED_MEDIA_TYPE
+    ]
 
 
 class InMemoryConversation:
@@ -358,27 +870,7 @@ class InMemoryConversation:
         conversation_history = self._load_conversation(conversation_id)
 
         # Add user message to history
-        if not isinstance(user_message, list):
-            user_message = [user_message]
-
-        for u in user_message:
-            if isinstance(u, dict):
-                if u.get("media_type") not in SUPPORTED_MEDIA_TYPE:
-                    continue
-
-                u = [
-                    {
-                        "source": u,
-                        "type": (
-                            "document"
-                            if u["media_type"] == "application/pdf"
-                            else "image"
-                        ),
-                    }
-                ]
-
-            msg = {"role": "user", "content": u}
-            conversation_history.append(msg)
+        conversation_history.extend(_user_messages(user_message))
 
         # Get response from agent (this modifies conversation_history in place)
         response = await self.agent.chat(
@@ -391,140 +883,328 @@ class InMemoryConversation:
         return conversation_id, response
 
 
+# Timestamps are stored as INTEGER epoch nanoseconds
+CONVERSATIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id TEXT PRIMARY KEY,
+        created_at INTEGER NOT NULL,
+        message_count INTEGER NOT NULL DEFAULT 0
+    )
+"""
+
+MESSAGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content BLOB NOT NULL,
+        created_at INTEGER NOT NULL,
+        FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+    )
+"""
+
+
+def _iso_to_ns(value: str) -> int:
+    return round(datetime.fromisoformat(value).timestamp() * 1_000_000) * 1000
+
+
+def _ns_to_iso(value: int) -> str:
+    return datetime.fromtimestamp(value / 1e9).isoformat()
+
+
+async def _migrate_created_at_to_ns(conn: aiosqlite.Connection) -> None:
+    """
+    One-shot migration for databases that stored created_at as ISO-8601 text.
+    SQLite can't change a column type in place, so each table is copied into a
+    new one with the INTEGER column and swapped in. Runs inside the caller's
+    transaction; the trigger and indexes are recreated by the caller.
+    """
+    async with conn.execute("PRAGMA table_info(messages)") as cursor:
+        columns = {row[1]: row[2] async for row in cursor}
+    if columns["created_at"].upper() != "TEXT":
+        return
+
+    await conn.create_function("iso_to_ns", 1, _iso_to_ns, deterministic=True)
+    await conn.execute("DROP TRIGGER IF EXISTS trg_messages_count")
+
+    for table, schema, column_names in (
+        ("conversations", CONVERSATIONS_TABLE, "id, message_count"),
+        ("messages", MESSAGES_TABLE, "id, conversation_id, role, content"),
+    ):
+        await conn.execute(schema.format(name=f"{table}_new"))
+        await conn.execute(
+            f"""
+            INSERT INTO {table}_new ({column_names}, created_at)
+            SELECT {column_names}, iso_to_ns(created_at) FROM {table}
+            """
+        )
+        await conn.execute(f"DROP TABLE {table}")
+        await conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
 class SQLiteConversation:
     """Stateless agent that persists conversations to SQLite database"""
 
     def __init__(self, agent: Any, db_path: str):
         self.agent = agent
         self.db_path = db_path
-        self._initialize_database()
 
-    def _initialize_database(self) -> None:
-        """Create database tables if they don't exist"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        # One connection for the lifetime of the instance, opened in
+        # initialize(). aiosqlite runs every statement on its own worker
+        # thread so commits never block the event loop.
+        self._conn: Optional[aiosqlite.Connection] = None
+
+        # Transactions are managed explicitly so a whole batch shares a single
+        # commit; the lock keeps concurrent chats from interleaving inside one
+        self._lock = asyncio.Lock()
+
+        # Message content is stored as zstd-compressed JSON. These objects are
+        # not safe for concurrent use, so they are only touched on the loop thread.
+        self._compressor = zstd.ZstdCompressor(level=3)
+        self._decompressor = zstd.ZstdDecompressor()
+
+    async def close(self) -> None:
+        """Close the underlying database connection"""
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    @asynccontextmanager
+    async def _transaction(self):
+        """Run the enclosed statements in a single transaction"""
+        async with self._lock:
+            await self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                await self._conn.execute("ROLLBACK")
+                raise
+            else:
+                await self._conn.execute("COMMIT")
 
+    async def _initialize_database(self) -> None:
+        """Create database tables if they don't exist"""
+        async with self._transaction() as conn:
             # Create conversations table
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id TEXT PRIMARY KEY,
-                    created_at TEXT NOT NULL
+            await conn.execute(CONVERSATIONS_TABLE.format(name="conversations"))
+
+            # Databases created before message_count existed get the column
+            # added and backfilled once
+            async with conn.execute("PRAGMA table_info(conversations)") as cursor:
+                columns = {row[1] async for row in cursor}
+            if "message_count" not in columns:
+                await conn.execute(
+                    """
+                    ALTER TABLE conversations
+                    ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0
+                    """
+                )
+                await conn.execute(
+                    """
+                    UPDATE conversations SET message_count = (
+                        SELECT COUNT(*) FROM messages
+                        WHERE messages.conversation_id = conversations.id
+                    )
+                    """
                 )
-                """
-            )
 
             # Create messages table
-            cursor.execute(
+            await conn.execute(MESSAGES_TABLE.format(name="messages"))
+
+            await _migrate_created_at_to_ns(conn)
+
+            # Image/document payloads, stored once and referenced by hash
+            await conn.execute(
                 """
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    conversation_id TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    data BLOB NOT NULL
                 )
                 """
             )
 
             # Create index for faster lookups
-            cursor.execute(
+            await conn.execute(
                 """
                 CREATE INDEX IF NOT EXISTS idx_messages_conversation_id
                 ON messages (conversation_id)
                 """
             )
 
-            conn.commit()
+            await conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_conversations_created_at
+                ON conversations (created_at DESC)
+                """
+            )
 
-    def _conversation_exists(self, conversation_id: str) -> bool:
-        """Check if a conversation exists in the database"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id FROM conversations WHERE id = ?", (conversation_id,)
+            # Keep message_count in step with inserts so listing never scans messages
+            await conn.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS trg_messages_count
+                AFTER INSERT ON messages
+                BEGIN
+                    UPDATE conversations SET message_count = message_count + 1
+                    WHERE id = NEW.conversation_id;
+                END
+                """
             )
-            return cursor.fetchone() is not None
 
-    def _create_conversation(self, conversation_id: str) -> None:
+    async def _conversation_exists(self, conversation_id: str) -> bool:
+        """Check if a conversation exists in the database"""
+        async with self._conn.execute(
+            "SELECT id FROM conversations WHERE id = ?", (conversation_id,)
+        ) as cursor:
+            return await cursor.fetchone() is not None
+
+    async def _create_conversation(self, conversation_id: str, created_at: int) -> None:
         """Create a new conversation entry in the database"""
-        created_at = datetime.now().isoformat()
+        await self._conn.execute(
+            "INSERT INTO conversations (id, created_at) VALUES (?, ?)",
+            (conversation_id, created_at),
+        )
 
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO conversations (id, created_at) VALUES (?, ?)",
-                (conversation_id, created_at),
-            )
-            conn.commit()
+    async def _store_attachments(self, content: Any) -> Any:
+        """Move base64 image/document payloads into blobs, leaving a reference"""
+        if not isinstance(content, list):
+            return content
 
-    def _save_message(self, conversation_id: str, role: str, content: Any) -> None:
-        """Save a single message to the database"""
-        created_at = datetime.now().isoformat()
-        content_json = json.dumps(content)
+        stored = []
+        for block in content:
+            source = block.get("source") if isinstance(block, dict) else None
 
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                INSERT INTO messages (conversation_id, role, content, created_at)
-                VALUES (?, ?, ?, ?)
-                """,
-                (conversation_id, role, content_json, created_at),
+            if source and source.get("type") == "base64":
+                data = b64decode(source["data"])
+                digest = hashlib.sha256(data).hexdigest()
+
+                await self._conn.execute(
+                    "INSERT OR IGNORE INTO blobs (hash, data) VALUES (?, ?)",
+                    (digest, data),
+                )
+
+                block = {
+                    **block,
+                    "source": {
+                        "type": "ref",
+                        "hash": digest,
+                        "media_type": source["media_type"],
+                    },
+                }
+
+            stored.append(block)
+
+        return stored
+
+    async def _load_attachments(self, messages: List[Dict[str, Any]]) -> None:
+        """Replace blob references in loaded messages with base64 sources"""
+        refs = [
+            block["source"]
+            for m in messages
+            if isinstance(m["content"], list)
+            for block in m["content"]
+            if isinstance(block, dict) and block.get("source", {}).get("type") == "ref"
+        ]
+        if not refs:
+            return
+
+        hashes = list({ref["hash"] for ref in refs})
+        placeholders = ",".join("?" * len(hashes))
+
+        async with self._conn.execute(
+            f"SELECT hash, data FROM blobs WHERE hash IN ({placeholders})", hashes
+        ) as cursor:
+            encoded = {h: b64encode(data).decode("ascii") async for h, data in cursor}
+
+        for ref in refs:
+            digest = ref.pop("hash")
+            ref["type"] = "base64"
+            ref["data"] = encoded[digest]
+
+    async def _encode_content(self, content: Any) -> bytes:
+        """Serialize and compress message content for storage"""
+        content = await self._store_attachments(content)
+        return self._compressor.compress(orjson.dumps(content))
+
+    def _decode_content(self, stored: bytes | str) -> Any:
+        """Inverse of _encode_content; older rows hold plain JSON text"""
+        if isinstance(stored, bytes):
+            stored = self._decompressor.decompress(stored)
+
+        return orjson.loads(stored)
+
+    async def _save_messages(
+        self, conversation_id: str, messages: List[Dict[str, Any]], created_at: int
+    ) -> None:
+        """Save a batch of messages; callers own the surrounding transaction"""
+        rows = [
+            (
+                conversation_id,
+                m["role"],
+                await self._encode_content(m["content"]),
+                created_at,
             )
-            conn.commit()
+            for m in messages
+        ]
+        await self._conn.executemany(
+            """
+            INSERT INTO messages (conversation_id, role, content, created_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            rows,
+        )
 
-    def _load_conversation(self, conversation_id: str) -> List[Dict[str, Any]]:
+    async def _load_conversation(self, conversation_id: str) -> List[Dict[str, Any]]:
         """Load conversation history from database"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT role, content FROM messages
-                WHERE conversation_id = ?
-                ORDER BY id ASC
-                """,
-                (conversation_id,),
-            )
+        async with self._conn.execute(
+            """
+            SELECT role, content FROM messages
+            WHERE conversation_id = ?
+            ORDER BY id ASC
+            """,
+            (conversation_id,),
+        ) as cursor:
+            rows = await cursor.fetchall()
 
-            messages = []
-            for row in cursor.fetchall():
-                role, content_json = row
-                content = json.loads(content_json)
-                messages.append({"role": role, "content": content})
+        messages = []
+        for role, content in rows:
+            messages.append({"role": role, "content": self._decode_content(content)})
 
-            return messages
+        await self._load_attachments(messages)
 
-    def list_conversations(self) -> List[Dict[str, Any]]:
+        return messages
+
+    async def list_conversations(self) -> List[Dict[str, Any]]:
         """List all conversations in the database"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT c.id, c.created_at, COUNT(m.id) as message_count
-                FROM conversations c
-                LEFT JOIN messages m ON c.id = m.conversation_id
-                GROUP BY c.id, c.created_at
-                ORDER BY c.created_at DESC
-                """
-            )
+        async with self._conn.execute(
+            """
+            SELECT id, created_at, message_count
+            FROM conversations
+            ORDER BY created_at DESC
+            """
+        ) as cursor:
+            rows = await cursor.fetchall()
 
-            conversations = []
-            for row in cursor.fetchall():
-                conv_id, created_at, message_count = row
-                conversations.append(
-                    {
-                        "id": conv_id,
-                        "created_at": created_at,
-                        "message_count": message_count,
-                    }
-                )
+        conversations = []
+        for conv_id, created_at, message_count in rows:
+            conversations.append(
+                {
+                    "id": conv_id,
+                    "created_at": _ns_to_iso(created_at),
+                    "message_count": message_count,
+                }
+            )
 
-            return conversations
+        return conversations
 
     async def initialize(self) -> None:
-        """Initialize the underlying agent"""
+        """Open the database and initialize the underlying agent"""
+        if self._conn is None:
+            self._conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+            await self._conn.execute("PRAGMA journal_mode=WAL")
+            await self._conn.execute("PRAGMA synchronous=NORMAL")
+            await self._conn.execute("PRAGMA temp_store=MEMORY")
+            await self._initialize_database()
+
         await self.agent.initialize()
 
     async def chat(
@@ -548,43 +1228,26 @@ class SQLiteConversation:
         if conversation_id is None:
             conversation_id = str(uuid.uuid4())
 
-        # Create conversation if it doesn't exist
-        if not self._conversation_exists(conversation_id):
-            self._create_conversation(conversation_id)
-
-        # Load existing conversation history from database
-        conversation_history = self._load_conversation(conversation_id)
-
-        # Add user message to history
-        if not isinstance(user_message, list):
-            user_message = [user_message]
+        # One timestamp for everything written for the user's turn
+        created_at = time.time_ns()
 
-        for u in user_message:
-            if isinstance(u, dict):
-                if u.get("media_type") not in SUPPORTED_MEDIA_TYPE:
-                    continue
+        async with self._transaction():
+            # Create conversation if it doesn't exist
+            if not await self._conversation_exists(conversation_id):
+                await self._create_conversation(conversation_id, created_at)
 
-                u = [
-                    {
-                        "source": u,
-                        "type": (
-                            "document"
-                            if u["media_type"] == "application/pdf"
-                            else "image"
-                        ),
-                    }
-                ]
+            # Load existing conversation history from database
+            conversation_history = await self._load_conversation(conversation_id)
 
-            msg = {"role": "user", "content": u}
-            self._save_message(conversation_id, "user", u)
-            conversation_history.append(msg)
+            # Add user message to history
+            new_messages = _user_messages(user_message)
+            await self._save_messages(conversation_id, new_messages, created_at)
+            conversation_history.extend(new_messages)
 
         # Track the number of messages before agent call
         initial_message_count = len(conversation_history)
 
-        from pprint import pp
-
-        pp(conversation_history)
+        logger.debug("History: %s", conversation_history)
 
         # Get response from agent (this modifies conversation_history in place)
         response = await self.agent.chat(
@@ -593,8 +1256,12 @@ class SQLiteConversation:
 
         # Save all new messages that were added by the agent
         # (assistant responses and tool results)
-        for message in conversation_history[initial_message_count:]:
-            self._save_message(conversation_id, message["role"], message["content"])
+        async with self._transaction():
+            await self._save_messages(
+                conversation_id,
+                conversation_history[initial_message_count:],
+                time.time_ns(),
+            )
 
         return conversation_id, response
 
@@ -606,10 +1273,15 @@ async def _init():
 
 
 def sync_chat():
-    agent = asyncio.run(_init())
+    # The async client's connection pool is bound to the loop it first ran on,
+    # so every call has to go through the same loop rather than asyncio.run
+    loop = _new_event_loop()
+    agent = loop.run_until_complete(_init())
 
     def _fn(text, previous_response_id):
-        return asyncio.run(agent.chat(text, conversation_id=previous_response_id))
+        return loop.run_until_complete(
+            agent.chat(text, conversation_id=previous_response_id)
+        )
 
     return _fn
 
@@ -717,4 +1389,4 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main(), loop_factory=_new_event_loop)
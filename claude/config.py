@@ -14,3 +14,19 @@ CLAUDE_MODEL = "claude-opus-4-5-20251101"
 # Optional: Advanced configuration
 CLAUDE_MAX_TOKENS = 4096
 REQUEST_TIMEOUT = 30
+MAX_CONCURRENT_TOOLS = 8
+
+# Older tool results are elided from requests once the history exceeds this
+# many (estimated) tokens; the most recent user turns are always sent in full
+MAX_HISTORY_TOKENS = 100_000
+KEEP_RECENT_TURNS = 4
+
+# Send tools as name + description only, with a get_tool_schema tool Claude
+# calls for the full input schema. Worth it with many MCP tools.
+LAZY_TOOL_SCHEMAS = False
+
+# Seconds a server's tools/list result is reused across restarts (0 disables)
+MCP_TOOL_CACHE_TTL = 300
+
+# chat_batch() uses the Message Batches API from this many conversations up
+BATCH_THRESHOLD = 10
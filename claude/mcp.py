@@ -1,219 +1,418 @@
-# import asyncio
-# import json
-# import sqlite3
-# import uuid
-# from datetime import datetime
-# from typing import Any, Dict, List, Optional
-
-# from anthropic import Anthropic
-# from anthropic.types import (
-#     Message,
-#     TextBlock,
-#     ToolUseBlock,
-# )
-# from anthropic.types.beta import BetaTextBlock
-
-# from fastmcp import Client
-
-
-# class ClaudeMCPAgent:
-#     """Agent that connects Claude to an HTTP MCP server"""
-
-#     def __init__(self, config: Config):
-#         self.config = config
-#         self.client = Anthropic(api_key=config.claude_api_key)
-#         self.mcp_clients: Dict[str, Client] = {}
-#         self.tools: List[Dict[str, Any]] = LOCAL_TOOLS.copy()
-
-#     async def initialize(self) -> None:
-#         """Initialize the agent by fetching tools from MCP server"""
-#         if self.config.mcp_server_urls:
-#             for url in self.config.mcp_server_urls:
-#                 print(f"Connecting to MCP server at {self.config.mcp_server_urls}...")
-
-#                 # Create FastMCP client
-#                 mcp_client = Client(
-#                     url,
-#                     timeout=self.config.request_timeout,
-#                 )
-
-#                 # Fetch available tools
-#                 tools = await self._fetch_tools(mcp_client)
-
-#                 print(f"✓ Loaded {len(tools)} tools from MCP server")
-
-#                 if tools:
-#                     self.tools.extend(tools)
-#                     print("\nAvailable tools:")
-#                     for tool in tools:
-#                         print(
-#                             f"  - {tool['name']}: {tool.get('description', 'No description')}"
-#                         )
-#                         self.mcp_clients[tool["name"]] = mcp_client
-
-#     async def _fetch_tools(self, mcp_client: Client) -> List[Dict[str, Any]]:
-#         """Fetch available tools from MCP server"""
-#         try:
-#             if not mcp_client:
-#                 raise Exception("MCP client not initialized")
-
-#             # Use FastMCP client to list tools
-#             async with mcp_client:
-#                 mcp_tools = await mcp_client.list_tools()
-
-#                 # Convert MCP tool format to Claude tool format
-#                 return self._convert_mcp_tools_to_claude_format(mcp_tools)
-#         except Exception as e:
-#             print(f"Error fetching tools from MCP server: {e}")
-#             return []
-
-#     def _convert_mcp_tools_to_claude_format(
-#         self, mcp_tools: List[Any]
-#     ) -> List[Dict[str, Any]]:
-#         """Convert MCP tool schema to Claude's expected format"""
-#         claude_tools = []
-#         for tool in mcp_tools:
-#             # FastMCP returns mcp.types.Tool objects
-#             claude_tool = {
-#                 "name": tool.name,
-#                 "description": tool.description or "",
-#                 "input_schema": tool.inputSchema
-#                 or {"type": "object", "properties": {}},
-#             }
-#             claude_tools.append(claude_tool)
-#         return claude_tools
-
-#     async def _execute_tool(self, tool_name: str, tool_input: Dict[str, Any]) -> Any:
-#         """Execute a tool via the MCP server or local tool call"""
-#         # Check if it's a local tool
-#         if tool_name in TOOL_HANDLERS:
-#             return execute_local_tool(tool_name, tool_input)
-
-#         try:
-#             mcp_client = self.mcp_clients.get(tool_name)
-#             if not mcp_client:
-#                 raise Exception("MCP client not initialized")
-
-#             # Use FastMCP client to call tool
-#             async with mcp_client:
-#                 result = await mcp_client.call_tool(
-#                     name=tool_name,
-#                     arguments=tool_input,
-#                     raise_on_error=False,  # Handle errors gracefully
-#                 )
-
-#                 # Convert CallToolResult to a dictionary for Claude
-#                 # If there's structured content, return it; otherwise return text content
-#                 if result.structured_content:
-#                     return result.structured_content
-
-#                 # Extract text from content blocks
-#                 response_text = []
-#                 for content in result.content:
-#                     if hasattr(content, "text"):
-#                         response_text.append(content.text)
-
-#                 if response_text:
-#                     return {"result": "\n".join(response_text)}
-
-#                 return {"result": "Tool executed successfully"}
-#         except Exception as e:
-#             return {"error": str(e)}
-
-#     async def chat(
-#         self,
-#         conversation_history: List[Dict[str, Any]],
-#         system_prompt: Optional[str] = None,
-#         betas: Optional[List[str]] = None,
-#         **kwargs,
-#     ) -> str:
-#         """
-#         Send a message to Claude and handle tool use in a loop
-
-#         Args:
-#             conversation_history: list of messages
-#             system_prompt: Optional system prompt to guide Claude's behavior
-
-#         Returns:
-#             Claude's final response as a string
-#         """
-#         # Process the conversation with potential tool use
-#         while True:
-#             # Prepare the API call
-
-#             # print("---------------")
-#             # from pprint import pp
-
-#             # for m in conversation_history:
-#             #     pp(m)
-#             # print("----------------")
-#             api_params = {**kwargs}
-
-#             api_params.update(
-#                 {
-#                     "model": self.config.claude_model,
-#                     "max_tokens": self.config.claude_max_tokens,
-#                     "messages": conversation_history,
-#                 }
-#             )
-
-#             # Add tools if available
-#             if self.tools:
-#                 api_params["tools"] = self.tools
-
-#             # Add system prompt if provided
-#             if system_prompt:
-#                 api_params["system"] = system_prompt
-
-#             # Call Claude API
-#             if betas:
-#                 response: Message = self.client.beta.messages.create(
-#                     **api_params, betas=betas
-#                 )
-#             else:
-#                 response: Message = self.client.messages.create(**api_params)
-
-#             # Check if Claude wants to use tools
-#             tool_use_blocks = [
-#                 block for block in response.content if isinstance(block, ToolUseBlock)
-#             ]
-
-#             if not tool_use_blocks:
-#                 # No tool use, extract and return the text response
-#                 text_blocks = [
-#                     block
-#                     for block in response.content
-#                     if isinstance(block, (TextBlock, BetaTextBlock))
-#                 ]
-#                 response_text = "\n".join(block.text for block in text_blocks)
-
-#                 # Add assistant's response to history
-#                 conversation_history.append(
-#                     {"role": "assistant", "content": response_text}
-#                 )
-
-#                 return response_text
-
-#             # Execute all requested tools
-#             for tool_use in tool_use_blocks:
-#                 print(f"\n🔧 Executing tool: {tool_use.name}")
-#                 print(f"   Input: {json.dumps(tool_use.input, indent=2)}")
-
-#                 result = await self._execute_tool(tool_use.name, tool_use.input)
-
-#                 print(f"   Result: {json.dumps(result, indent=2)}")
-#                 conversation_history.append(
-#                     {"role": "assistant", "content": [tool_use.model_dump()]}
-#                 )
-#                 conversation_history.append(
-#                     {
-#                         "role": "user",
-#                         "content": [
-#                             {
-#                                 "type": "tool_result",
-#                                 "tool_use_id": tool_use.id,
-#                                 "content": json.dumps(result),
-#                             }
-#                         ],
-#                     }
-#                 )
+import asyncio
+import logging
+import os
+import time
+
+from contextlib import AsyncExitStack
+from functools import partial
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+import aiosqlite
+import orjson
+
+from fastmcp import Client
+
+from .agent import DATA_PATH, ClaudeAgent, Config, _tools_wire
+from .tools import LOCAL_TOOLS, TOOL_HANDLERS
+
+
+logger = logging.getLogger(__name__)
+
+TOOL_CACHE_PATH = os.path.join(DATA_PATH, "claude_mcp_tools.db")
+
+
+class _ToolCache:
+    """tools/list results per MCP server URL, reused while younger than ttl"""
+
+    def __init__(self, db_path: str, ttl: float):
+        self.db_path = db_path
+        self.ttl_ns = int(ttl * 1e9)
+        self._conn: Optional[aiosqlite.Connection] = None
+
+    async def __aenter__(self) -> "_ToolCache":
+        if self.ttl_ns > 0:
+            self._conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+            await self._conn.execute("PRAGMA journal_mode=WAL")
+            await self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tools (
+                    url TEXT PRIMARY KEY,
+                    fetched_at INTEGER NOT NULL,
+                    tools BLOB NOT NULL
+                )
+                """
+            )
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+
+    async def get(self, url: str) -> Optional[List[Dict[str, Any]]]:
+        """Cached tools for a server, or None if missing or stale"""
+        if self._conn is None:
+            return None
+
+        async with self._conn.execute(
+            "SELECT tools FROM tools WHERE url = ? AND fetched_at > ?",
+            (url, time.time_ns() - self.ttl_ns),
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        return orjson.loads(row[0]) if row else None
+
+    async def put(self, url: str, tools: List[Dict[str, Any]]) -> None:
+        """Store a freshly fetched tool list"""
+        if self._conn is None:
+            return
+
+        await self._conn.execute(
+            "INSERT OR REPLACE INTO tools (url, fetched_at, tools) VALUES (?, ?, ?)",
+            (url, time.time_ns(), orjson.dumps(tools)),
+        )
+
+
+GET_TOOL_SCHEMA = {
+    "name": "get_tool_schema",
+    "description": (
+        "Get the full input schema of a tool. Tools are listed by name and "
+        "description only; call this before using one of them."
+    ),
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string", "description": "Name of the tool"},
+        },
+        "required": ["name"],
+    },
+}
+
+
+def _lite_tool(tool: Dict[str, Any]) -> Dict[str, Any]:
+    """A tool definition without its input schema"""
+    return {
+        "name": tool["name"],
+        "description": tool["description"],
+        "input_schema": {"type": "object", "properties": {}},
+    }
+
+
+def _requested_schemas(conversation_history: List[Dict[str, Any]]) -> Set[str]:
+    """Names of the tools whose schema Claude asked for in this conversation"""
+    return {
+        block["input"].get("name")
+        for message in conversation_history
+        if message["role"] == "assistant" and isinstance(message["content"], list)
+        for block in message["content"]
+        if isinstance(block, dict)
+        and block.get("type") == "tool_use"
+        and block.get("name") == GET_TOOL_SCHEMA["name"]
+    }
+
+
+class ClaudeMCPAgent(ClaudeAgent):
+    """
+    Agent that connects Claude to an HTTP MCP server
+
+    MCP sessions stay open from initialize() until aclose(), so use the agent
+    as an async context manager or call aclose() when done with it.
+    """
+
+    def __init__(self, config: Config):
+        super().__init__(config)
+        self.mcp_clients: Dict[str, Client] = {}
+        self._clients_by_url: Dict[str, Client] = {}
+        self._stack = AsyncExitStack()
+
+        # Caps in-flight MCP tool calls when Claude asks for many at once
+        self._tool_sem = asyncio.Semaphore(config.max_concurrent_tools)
+
+        # Tool name -> bound handler, so a call is a single lookup. Local tools
+        # take precedence over MCP tools of the same name.
+        self._dispatch: Dict[str, Callable[[Dict[str, Any]], Awaitable[Any]]] = {
+            name: partial(self._call_local, name) for name in TOOL_HANDLERS
+        }
+
+    async def __aenter__(self) -> "ClaudeMCPAgent":
+        await self.initialize()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """
+        Close every MCP session opened by initialize(). The MCP tools go with
+        them; local tools keep working.
+        """
+        for tool_name in self.mcp_clients:
+            handler = self._dispatch.get(tool_name)
+            if isinstance(handler, partial) and handler.func == self._call_remote:
+                del self._dispatch[tool_name]
+        self.mcp_clients.clear()
+        self._clients_by_url.clear()
+        await self._stack.aclose()
+
+        self._set_tools([])
+
+    async def initialize(self) -> None:
+        """Initialize the agent by fetching tools from all MCP servers concurrently"""
+        mcp_tools = []
+        if self.config.mcp_server_urls:
+            # A URL listed more than once shares a single client
+            urls = list(dict.fromkeys(self.config.mcp_server_urls))
+            async with _ToolCache(
+                TOOL_CACHE_PATH, self.config.mcp_tool_cache_ttl
+            ) as tool_cache:
+                results = await asyncio.gather(
+                    *[self._connect_one(url, tool_cache) for url in urls],
+                    return_exceptions=True,
+                )
+
+            # Register clients and tools only once every server has answered
+            for url, result in zip(urls, results):
+                if isinstance(result, Exception):
+                    logger.error(
+                        "Error connecting to MCP server at %s: %s", url, result
+                    )
+                    continue
+
+                mcp_client, tools = result
+                self._clients_by_url[url] = mcp_client
+
+                logger.info("✓ Loaded %d tools from MCP server at %s", len(tools), url)
+
+                if tools:
+                    mcp_tools.extend(tools)
+                    for tool in tools:
+                        logger.debug(
+                            "  - %s: %s",
+                            tool["name"],
+                            tool.get("description", "No description"),
+                        )
+                        self.mcp_clients[tool["name"]] = mcp_client
+                        self._dispatch.setdefault(
+                            tool["name"],
+                            partial(self._call_remote, mcp_client, tool["name"]),
+                        )
+
+        self._set_tools(mcp_tools)
+
+    def _set_tools(self, mcp_tools: List[Dict[str, Any]]) -> None:
+        """Offer the local tools plus the given MCP tools"""
+        tools = [*LOCAL_TOOLS, *mcp_tools]
+        if self.config.lazy_tool_schemas:
+            self._full_tools = {tool["name"]: tool for tool in tools}
+            self._lite_tools = [*map(_lite_tool, tools), GET_TOOL_SCHEMA]
+            self._dispatch[GET_TOOL_SCHEMA["name"]] = self._get_tool_schema
+            tools = self._lite_tools
+
+        self.tools = _tools_wire(tools)
+
+    def _tools_for(
+        self, conversation_history: List[Dict[str, Any]]
+    ) -> Sequence[Dict[str, Any]]:
+        """
+        With lazy schemas, attach the full schema of every tool Claude has
+        asked about so far. The set is read back from the history, so it is
+        per conversation and survives persistence.
+        """
+        if not self.config.lazy_tool_schemas:
+            return self.tools
+
+        requested = _requested_schemas(conversation_history)
+        if not requested:
+            return self.tools
+
+        return _tools_wire(
+            [
+                (
+                    self._full_tools.get(tool["name"], tool)
+                    if tool["name"] in requested
+                    else tool
+                )
+                for tool in self._lite_tools
+            ]
+        )
+
+    async def _get_tool_schema(self, tool_input: Dict[str, Any]) -> Any:
+        """Handler for the get_tool_schema meta-tool"""
+        tool = self._full_tools.get(tool_input.get("name"))
+        if tool is None:
+            return {"error": f"Unknown tool: {tool_input.get('name')}"}
+
+        return {"name": tool["name"], "input_schema": tool["input_schema"]}
+
+    async def _connect_one(
+        self, url: str, tool_cache: _ToolCache
+    ) -> Tuple[Client, List[Dict[str, Any]]]:
+        """Open a session to one MCP server and fetch its tools"""
+        logger.info("Connecting to MCP server at %s...", url)
+
+        # Create FastMCP client and keep its session open so every tool call
+        # reuses the same transport
+        mcp_client = await self._stack.enter_async_context(
+            Client(
+                url,
+                timeout=self.config.request_timeout,
+            )
+        )
+
+        # Fetch available tools, unless a recent list is cached
+        tools = await tool_cache.get(url)
+        if tools is None:
+            tools = await self._fetch_tools(mcp_client)
+            if tools:
+                await tool_cache.put(url, tools)
+
+        return mcp_client, tools
+
+    async def _fetch_tools(self, mcp_client: Client) -> List[Dict[str, Any]]:
+        """Fetch available tools from MCP server"""
+        try:
+            if not mcp_client:
+                raise Exception("MCP client not initialized")
+
+            # Use FastMCP client to list tools
+            mcp_tools = await mcp_client.list_tools()
+
+            # Convert MCP tool format to Claude tool format
+            return self._convert_mcp_tools_to_claude_format(mcp_tools)
+        except Exception as e:
+            logger.error("Error fetching tools from MCP server: %s", e)
+            return []
+
+    def _convert_mcp_tools_to_claude_format(
+        self, mcp_tools: List[Any]
+    ) -> List[Dict[str, Any]]:
+        """Convert MCP tool schema to Claude's expected format"""
+        claude_tools = []
+        for tool in mcp_tools:
+            # FastMCP returns mcp.types.Tool objects
+            claude_tool = {
+                "name": tool.name,
+                "description": tool.description or "",
+                "input_schema": tool.inputSchema
+                or {"type": "object", "properties": {}},
+            }
+            claude_tools.append(claude_tool)
+        return claude_tools
+
+    async def _execute_tool(self, tool_name: str, tool_input: Dict[str, Any]) -> Any:
+        """Execute a tool via the MCP server or local tool call"""
+        handler = self._dispatch.get(tool_name)
+        if handler is None:
+            return {"error": f"Unknown tool: {tool_name}"}
+
+        return await handler(tool_input)
+
+    async def _call_local(self, tool_name: str, tool_input: Dict[str, Any]) -> Any:
+        """Execute a local tool without blocking the event loop"""
+        return await super()._execute_tool(tool_name, tool_input)
+
+    async def _call_remote(
+        self, mcp_client: Client, tool_name: str, tool_input: Dict[str, Any]
+    ) -> Any:
+        """Execute a tool via the MCP server"""
+        try:
+            # Use FastMCP client to call tool
+            async with self._tool_sem:
+                result = await mcp_client.call_tool(
+                    name=tool_name,
+                    arguments=tool_input,
+                    raise_on_error=False,  # Handle errors gracefully
+                )
+
+            # Convert CallToolResult to a dictionary for Claude
+            # If there's structured content, return it; otherwise return text content
+            if result.structured_content:
+                return result.structured_content
+
+            # Extract text from content blocks
+            response_text = []
+            for content in result.content:
+                if hasattr(content, "text"):
+                    response_text.append(content.text)
+
+            if response_text:
+                return {"result": "\n".join(response_text)}
+
+            return {"result": "Tool executed successfully"}
+        except Exception as e:
+            return {"error": str(e)}
+
+
+class AgentPool:
+    """
+    Hands out one initialized ClaudeMCPAgent per configuration, so callers
+    that would build an agent per request share its tool list and its open
+    MCP and Anthropic connections instead. The agent's chat() holds no
+    per-call state and can be awaited concurrently.
+
+    Those connections belong to the event loop that opened them, so each
+    running loop gets its own pool. Pools of loops that have since closed,
+    e.g. an earlier asyncio.run(), are dropped.
+    """
+
+    _pools: Dict[
+        asyncio.AbstractEventLoop, Tuple[asyncio.Lock, Dict[Tuple, ClaudeMCPAgent]]
+    ] = {}
+
+    @staticmethod
+    def _key(config: Config) -> Tuple:
+        return tuple(
+            (name, tuple(value) if isinstance(value, list) else value)
+            for name, value in sorted(vars(config).items())
+        )
+
+    @classmethod
+    def _pool(cls) -> Tuple[asyncio.Lock, Dict[Tuple, ClaudeMCPAgent]]:
+        """The lock and agents belonging to the running loop"""
+        loop = asyncio.get_running_loop()
+
+        for closed in [other for other in cls._pools if other.is_closed()]:
+            del cls._pools[closed]
+
+        pool = cls._pools.get(loop)
+        if pool is None:
+            pool = cls._pools[loop] = (asyncio.Lock(), {})
+        return pool
+
+    @classmethod
+    async def get(cls, config: Config) -> ClaudeMCPAgent:
+        """The shared agent for this configuration, created on first use"""
+        key = cls._key(config)
+        lock, agents = cls._pool()
+
+        async with lock:
+            agent = agents.get(key)
+            if agent is None:
+                agent = ClaudeMCPAgent(config)
+                await agent.initialize()
+                agents[key] = agent
+
+        return agent
+
+    @classmethod
+    async def aclose_all(cls) -> None:
+        """
+        Close every agent pooled on the running loop; later get() calls start
+        fresh ones
+        """
+        lock, pooled = cls._pool()
+        async with lock:
+            agents = list(pooled.values())
+            pooled.clear()
+
+        for agent in agents:
+            await agent.aclose()
@@ -0,0 +1,58 @@
+"""
+Image and document blocks for Claude messages. Kept free of the agent's
+dependencies so callers such as the Slack helpers can build blocks without
+importing the agent.
+"""
+
+import mmap
+
+from base64 import b64encode
+from pathlib import Path
+
+EXT_MAP = {
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "webp": "image/webp",
+    "pdf": "application/pdf",
+}
+
+SUPPORTED_MEDIA_TYPE = set(EXT_MAP.values())
+
+
+def claude_image_block(image_path: Path):
+    assert image_path.is_file(), f"Target not a file: {image_path}"
+
+    media_type = EXT_MAP.get(image_path.suffix[1:].lower())
+    assert media_type, f"Unrecognised ext and media_type for: {image_path}"
+
+    # Encode straight from the mapped file instead of reading a copy into memory
+    with open(image_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = b64encode(mm)
+
+    return _claude_image_block(media_type, data)
+
+
+def claude_image_block_from_bytes(ext: str, b: bytes):
+    media_type = EXT_MAP.get(ext.lower())
+    assert media_type, f"Unrecognised ext and media_type for: {ext}"
+
+    return _claude_image_block(media_type, b64encode(b))
+
+
+def _claude_image_block(media_type: str, data: bytes):
+    return {
+        "role": "user",
+        "content": [
+            {
+                "source": {
+                    "data": data.decode("ascii"),
+                    "media_type": media_type,
+                    "type": "base64",
+                },
+                "type": "image",
+            }
+        ],
+    }
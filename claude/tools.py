@@ -3,12 +3,16 @@ Local tools for Claude API agent
 """
 
 import os
+import re
+import stat
+import tempfile
 import threading
 import logging
 
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, Literal
+from typing import Any, Dict, List, Literal, Tuple
 
 # Import calendar functions
 from icloud.calendar import (
@@ -68,47 +72,105 @@ MARKDOWN_DIRECTORY = (
     "/Users/kckc/Library/Mobile Documents/iCloud~md~obsidian/Documents/Family/"
 )
 
+# Resolved once; per-call paths are checked against it with normpath, which
+# needs no syscalls, instead of resolve()
+_RESOLVED_MARKDOWN_DIR = os.path.realpath(MARKDOWN_DIRECTORY)
+_RESOLVED_MARKDOWN_DIR_SEP = _RESOLVED_MARKDOWN_DIR + os.sep
+
 # Configuration: Path to todo list file
 TODO_FILE_PATH = os.path.join(MARKDOWN_DIRECTORY, "Family Todo.md")
 
 
+# Local timezone, looked up once. It is a fixed offset, which is exact for
+# Asia/Singapore (no daylight saving).
+_LOCAL_TZ = datetime.now().astimezone().tzinfo
+
+
 def get_current_datetime() -> Dict[str, Any]:
     """Get the current date and time with timezone information"""
-    try:
-        # Get current datetime with local timezone
-        now = datetime.now().astimezone()
+    return datetime.now(tz=_LOCAL_TZ).isoformat()
 
-        return now.isoformat()
-    except Exception as e:
-        return {"error": str(e)}
 
+# Prefix trie of the markdown file names, rebuilt when the directory's mtime
+# changes. Each node maps a character to its child node; the None key holds
+# the file name ending at that node.
+_FILES_TRIE: Dict[str, Any] = {"key": None, "root": None}
 
-def list_markdown_files() -> Dict[str, Any]:
-    """List all markdown files in the configured directory (non-recursive)"""
-    try:
-        directory = Path(MARKDOWN_DIRECTORY)
 
-        if not directory.exists():
+def _scan_markdown_files(directory: str) -> List[str]:
+    """Names of the markdown files in the directory (non-recursive)"""
+    with os.scandir(directory) as entries:
+        return [
+            entry.name
+            for entry in entries
+            if entry.name.endswith(".md")
+            and not entry.name.startswith(".")
+            and entry.is_file(follow_symlinks=False)
+        ]
+
+
+def _markdown_files_trie(directory: str) -> Dict[Any, Any]:
+    """Root of the file name trie, rebuilt only if the directory has changed"""
+    key = os.stat(directory).st_mtime_ns
+
+    if _FILES_TRIE["key"] != key:
+        root: Dict[Any, Any] = {}
+        # Inserting in sorted order keeps every node's children sorted too
+        for name in sorted(_scan_markdown_files(directory)):
+            node = root
+            for char in name:
+                node = node.setdefault(char, {})
+            node[None] = name
+
+        _FILES_TRIE.update(key=key, root=root)
+
+    return _FILES_TRIE["root"]
+
+
+def _collect_names(node: Dict[Any, Any], names: List[str]) -> None:
+    """Append every file name under a trie node, in sorted order"""
+    for char, child in node.items():
+        if char is None:
+            names.append(child)
+        else:
+            _collect_names(child, names)
+
+
+def list_markdown_files(prefix: str = "") -> Dict[str, Any]:
+    """
+    List all markdown files in the configured directory (non-recursive)
+
+    Args:
+        prefix: Only list files whose name starts with this
+    """
+    try:
+        if not os.path.exists(MARKDOWN_DIRECTORY):
             return {"error": f"Directory does not exist: {MARKDOWN_DIRECTORY}"}
 
-        if not directory.is_dir():
+        if not os.path.isdir(MARKDOWN_DIRECTORY):
             return {"error": f"Path is not a directory: {MARKDOWN_DIRECTORY}"}
 
-        # Find all .md and .markdown files in the directory (non-recursive)
-        markdown_files = []
-        for pattern in [
-            "*.md",
-        ]:
-            markdown_files.extend(directory.glob(pattern))
+        # Walk down to the prefix, then collect everything below it
+        node = _markdown_files_trie(MARKDOWN_DIRECTORY)
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return ""
 
-        # Sort by name and convert to strings
-        files = sorted([f.name for f in markdown_files if not f.name.startswith(".")])
+        files: List[str] = []
+        _collect_names(node, files)
 
         return "\n".join(files)
     except Exception as e:
         return {"error": str(e)}
 
 
+@lru_cache(maxsize=32)
+def _cached_read(path: str, key: Tuple[int, int]) -> str:
+    """Text of a markdown file; key is its (mtime, size) so edits miss"""
+    return Path(path).read_text(encoding="utf-8")
+
+
 def read_markdown_file(filename: str) -> Dict[str, Any]:
     """
     Read the content of a markdown file from the configured directory.
@@ -118,38 +180,33 @@ def read_markdown_file(filename: str) -> Dict[str, Any]:
         if not filename:
             return {"error": "Missing required argument: filename"}
 
-        # Validate directory exists
-        directory = Path(MARKDOWN_DIRECTORY)
-        if not directory.exists():
-            return {"error": f"Directory does not exist: {MARKDOWN_DIRECTORY}"}
-
-        if not directory.is_dir():
-            return {"error": f"Path is not a directory: {MARKDOWN_DIRECTORY}"}
-
-        # Construct the full path
-        file_path = directory / filename
-
-        # Security: Resolve both paths and ensure the file is within the allowed directory
-        resolved_file = file_path.resolve()
+        # Security: ensure the file is within the allowed directory
+        file_path = _markdown_path(filename)
+        if file_path is None:
+            return {
+                "error": f"Access denied: File must be in {MARKDOWN_DIRECTORY}. Path traversal detected."
+            }
 
         # Check if file exists
-        if not resolved_file.exists():
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
             return {
                 "error": f"File not found: {filename}. Use list_markdown_files() to see available files."
             }
 
         # Check if it's a file (not a directory)
-        if not resolved_file.is_file():
+        if not stat.S_ISREG(st.st_mode):
             return {"error": f"Not a file: {filename}"}
 
         # Check if it has a .md extension
-        if resolved_file.suffix.lower() not in [".md", ".markdown"]:
+        if os.path.splitext(file_path)[1].lower() not in [".md", ".markdown"]:
             return {
                 "error": f"Invalid file type: {filename}. Only .md files can be read."
             }
 
-        # Read the file content
-        content = resolved_file.read_text(encoding="utf-8")
+        # Read the file content, unless it is unchanged since the last read
+        content = _cached_read(file_path, (st.st_mtime_ns, st.st_size))
 
         return content
     except Exception as e:
@@ -168,14 +225,6 @@ def write_markdown_file(filename: str, content: str) -> Dict[str, Any]:
         if not content:
             return {"error": "Missing required argument: content"}
 
-        # Validate directory exists
-        directory = Path(MARKDOWN_DIRECTORY)
-        if not directory.exists():
-            return {"error": f"Directory does not exist: {MARKDOWN_DIRECTORY}"}
-
-        if not directory.is_dir():
-            return {"error": f"Path is not a directory: {MARKDOWN_DIRECTORY}"}
-
         # Validate filename doesn't contain path separators
         if "/" in filename or "\\" in filename:
             return {
@@ -188,65 +237,138 @@ def write_markdown_file(filename: str, content: str) -> Dict[str, Any]:
                 "error": f"Invalid filename: {filename}. Filename must end with .md extension."
             }
 
-        # Construct the full path
-        file_path = directory / filename
-
-        # Security: Resolve both paths and ensure the file is within the allowed directory
-        resolved_file = file_path.resolve()
-        resolved_directory = directory.resolve()
-
-        # Check if the resolved file path is within the allowed directory
-        if not str(resolved_file).startswith(str(resolved_directory)):
+        # Security: ensure the file is within the allowed directory
+        file_path = _markdown_path(filename)
+        if file_path is None:
             return {
                 "error": f"Access denied: File must be in {MARKDOWN_DIRECTORY}. Path traversal detected."
             }
 
         # Write the content to the file
-        resolved_file.write_text(content, encoding="utf-8")
+        _atomic_write(file_path, content.encode("utf-8"))
+        _cached_read.cache_clear()
 
         return f"Successfully wrote {len(content)} characters to {filename}"
     except Exception as e:
         return {"error": str(e)}
 
 
+def _new_file_mode() -> int:
+    """
+    The mode open() gives a new file. The umask is read from /proc where
+    there is one, since os.umask can only read it by briefly changing it for
+    every thread; elsewhere new files get 0644.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("Umask:"):
+                    return 0o666 & ~int(line.split()[1], 8)
+    except OSError:
+        pass
+
+    return 0o644
+
+
+_NEW_FILE_MODE = _new_file_mode()
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    """
+    Replace a file's content. The data is written and fsynced to a temporary
+    file next to it, then moved over it, so readers and crashes never see a
+    truncated or half-written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            # mkstemp creates the file 0600; keep the mode of the one replaced,
+            # or give a new file the mode open() would have
+            try:
+                mode = stat.S_IMODE(os.stat(path).st_mode)
+            except FileNotFoundError:
+                mode = _NEW_FILE_MODE
+            os.fchmod(f.fileno(), mode)
+
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _markdown_path(filename: str) -> str | None:
+    """Full path of a file in the markdown directory, or None if it escapes it"""
+    candidate = os.path.normpath(os.path.join(_RESOLVED_MARKDOWN_DIR, filename))
+    if not candidate.startswith(_RESOLVED_MARKDOWN_DIR_SEP):
+        return None
+
+    return candidate
+
+
+# An unticked todo line; the group is its description
+_TODO_RE = re.compile(rb"(?m)^[ \t]*- \[ \] ?(.*)$")
+
+# Single-slot cache of the parsed todo file, keyed on its mtime and size
+_TODO_CACHE: Dict[str, Any] = {"key": None, "buf": None, "unticked": None}
+
+
+def _load_todos() -> Tuple[bytes, Tuple[Tuple[int, int, str], ...]]:
+    """
+    Read the todo file and find the unticked items as (start, end,
+    description), where start and end are the byte offsets of the item's
+    line without its newline. The file is only re-read when it has changed
+    since the last call.
+
+    Raises:
+        FileNotFoundError: if the todo file does not exist
+    """
+    st = os.stat(TODO_FILE_PATH)
+    key = (st.st_mtime_ns, st.st_size)
+
+    if _TODO_CACHE["key"] != key:
+        buf = Path(TODO_FILE_PATH).read_bytes()
+        unticked = tuple(
+            (m.start(), m.end(), m.group(1).decode("utf-8").strip())
+            for m in _TODO_RE.finditer(buf)
+        )
+
+        _TODO_CACHE.update(key=key, buf=buf, unticked=unticked)
+
+    return _TODO_CACHE["buf"], _TODO_CACHE["unticked"]
+
+
+def _write_todos(content: bytes) -> None:
+    """Replace the todo file and drop the parsed copy"""
+    try:
+        _atomic_write(TODO_FILE_PATH, content)
+    finally:
+        _TODO_CACHE["key"] = None
+
+
 def list_todos() -> Dict[str, Any]:
     """
     List all todo items from the markdown file.
     Returns only unticked items in a table format with id and description
     """
     try:
-        file_path = Path(TODO_FILE_PATH)
-
-        if not file_path.exists():
+        try:
+            _, todos = _load_todos()
+        except FileNotFoundError:
             return {"error": f"Todo file not found: {TODO_FILE_PATH}"}
 
-        # Read the file content
-        content = file_path.read_text(encoding="utf-8")
-        lines = content.strip().split("\n")
-
-        # Parse todos
-        todos = []
-        for line in lines:
-            line = line.strip()
-            if line.startswith("- [ ]"):
-                # Unticked item
-                description = line[6:].strip()  # Remove "- [ ] " prefix
-                todos.append({"completed": False, "description": description})
-            elif line.startswith("- [x]") or line.startswith("- [X]"):
-                # Ticked item (skip these)
-                continue
-
         # Format as table
         if not todos:
             return "No incomplete todos found."
 
         # Create table
-        result = "| Todo ID | Description |\n"
-        result += "|---------|-------------|\n"
-        for idx, todo in enumerate(todos, start=1):
-            result += f"| {idx} | {todo['description']} |\n"
-
-        return result
+        rows = (
+            f"| {idx} | {description} |\n"
+            for idx, (_, _, description) in enumerate(todos, start=1)
+        )
+        return "| Todo ID | Description |\n|---------|-------------|\n" + "".join(rows)
     except Exception as e:
         return {"error": str(e)}
 
@@ -269,19 +391,19 @@ def add_todo(description: str) -> Dict[str, Any]:
             file_path.parent.mkdir(parents=True, exist_ok=True)
             file_path.write_text("", encoding="utf-8")
 
-        # Read existing content
-        content = file_path.read_text(encoding="utf-8")
-
-        # Add new todo
-        new_todo = f"- [ ] {description}\n"
+        # Only the last byte is read, to know whether a newline is missing
+        prefix = b""
+        if os.stat(file_path).st_size > 0:
+            with open(file_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    prefix = b"\n"
 
-        # Append to file
-        if content and not content.endswith("\n"):
-            content += "\n"
-        content += new_todo
-
-        # Write back to file
-        file_path.write_text(content, encoding="utf-8")
+        # Append the new todo without rewriting the rest of the file
+        new_todo = f"- [ ] {description}\n".encode("utf-8")
+        with open(file_path, "ab") as f:
+            f.write(prefix + new_todo)
+        _TODO_CACHE["key"] = None
 
         return f"Successfully added todo: {description}"
     except Exception as e:
@@ -296,43 +418,20 @@ def delete_todo(todo_id: int) -> Dict[str, Any]:
         todo_id: The ID of the todo to delete (from list_todos)
     """
     try:
-        file_path = Path(TODO_FILE_PATH)
-
-        if not file_path.exists():
+        try:
+            buf, unticked = _load_todos()
+        except FileNotFoundError:
             return {"error": f"Todo file not found: {TODO_FILE_PATH}"}
 
-        # Read the file content
-        content = file_path.read_text(encoding="utf-8")
-        lines = content.strip().split("\n")
-
-        # Parse unticked todos
-        unticked_lines = []
-        all_lines = []
-        unticked_indices = []
-
-        for idx, line in enumerate(lines):
-            all_lines.append(line)
-            if line.strip().startswith("- [ ]"):
-                unticked_lines.append(line)
-                unticked_indices.append(idx)
-
         # Validate todo_id
-        if todo_id < 1 or todo_id > len(unticked_lines):
+        if todo_id < 1 or todo_id > len(unticked):
             return {
-                "error": f"Invalid todo ID: {todo_id}. Valid range: 1-{len(unticked_lines)}"
+                "error": f"Invalid todo ID: {todo_id}. Valid range: 1-{len(unticked)}"
             }
 
-        # Get the line index to delete
-        line_to_delete = unticked_indices[todo_id - 1]
-
-        # Remove the line
-        all_lines.pop(line_to_delete)
-
-        # Write back to file
-        new_content = "\n".join(all_lines)
-        if new_content and not new_content.endswith("\n"):
-            new_content += "\n"
-        file_path.write_text(new_content, encoding="utf-8")
+        # Remove the line along with its newline
+        start, end, _ = unticked[todo_id - 1]
+        _write_todos(buf[:start] + buf[end + 1 :])
 
         return f"Successfully deleted todo ID: {todo_id}"
     except Exception as e:
@@ -351,43 +450,21 @@ def update_todo(todo_id: int, description: str) -> Dict[str, Any]:
         if not description:
             return {"error": "Description cannot be empty"}
 
-        file_path = Path(TODO_FILE_PATH)
-
-        if not file_path.exists():
+        try:
+            buf, unticked = _load_todos()
+        except FileNotFoundError:
             return {"error": f"Todo file not found: {TODO_FILE_PATH}"}
 
-        # Read the file content
-        content = file_path.read_text(encoding="utf-8")
-        lines = content.strip().split("\n")
-
-        # Parse unticked todos
-        unticked_lines = []
-        all_lines = []
-        unticked_indices = []
-
-        for idx, line in enumerate(lines):
-            all_lines.append(line)
-            if line.strip().startswith("- [ ]"):
-                unticked_lines.append(line)
-                unticked_indices.append(idx)
-
         # Validate todo_id
-        if todo_id < 1 or todo_id > len(unticked_lines):
+        if todo_id < 1 or todo_id > len(unticked):
             return {
-                "error": f"Invalid todo ID: {todo_id}. Valid range: 1-{len(unticked_lines)}"
+                "error": f"Invalid todo ID: {todo_id}. Valid range: 1-{len(unticked)}"
             }
 
-        # Get the line index to update
-        line_to_update = unticked_indices[todo_id - 1]
-
-        # Update the line
-        all_lines[line_to_update] = f"- [ ] {description}"
-
-        # Write back to file
-        new_content = "\n".join(all_lines)
-        if new_content and not new_content.endswith("\n"):
-            new_content += "\n"
-        file_path.write_text(new_content, encoding="utf-8")
+        # Replace the line in place
+        start, end, _ = unticked[todo_id - 1]
+        new_todo = f"- [ ] {description}".encode("utf-8")
+        _write_todos(buf[:start] + new_todo + buf[end:])
 
         return f"Successfully updated todo ID {todo_id} to: {description}"
     except Exception as e:
@@ -429,7 +506,12 @@ LOCAL_TOOLS = [
         "description": f"Lists all markdown files (extension .md) in the configured directory: {MARKDOWN_DIRECTORY}. Use this tool to get the list of available file names before reading them.",
         "input_schema": {
             "type": "object",
-            "properties": {},
+            "properties": {
+                "prefix": {
+                    "type": "string",
+                    "description": "Optional. Only list files whose name starts with this prefix (case-sensitive).",
+                }
+            },
             "required": [],
         },
     },
@@ -694,6 +776,29 @@ TOOL_HANDLERS = {
 }
 
 
+# Handlers cheap enough to run on the event loop. Everything else touches the
+# filesystem, the network or EventKit and is run in a worker thread.
+INLINE_TOOLS = frozenset({"get_current_datetime"})
+
+
+# Handlers that change files or calendars. Two of them running at once can
+# lose an update (and todo ids shift after a delete), and a read requested
+# after one must see its result, so each waits for the calls requested before
+# it and the calls requested after it wait for it.
+MUTATING_TOOLS = frozenset(
+    {
+        "markdown__write_markdown_file",
+        "todo__add_todo",
+        "todo__delete_todo",
+        "todo__update_todo",
+        "calendar__create_event",
+        "calendar__update_event",
+        "calendar__create_reminder",
+        "calendar__update_reminder",
+    }
+)
+
+
 def execute_local_tool(tool_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
     """
     Execute a local tool by name
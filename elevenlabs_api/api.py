@@ -1,7 +1,9 @@
 import os
 from typing import IO
 from elevenlabs import ElevenLabs, VoiceSettings
+from functools import partial
 from itertools import groupby
+from operator import attrgetter
 
 _api_key = os.environ["ELEVEN_LABS_API_KEY"]
 
@@ -9,66 +11,49 @@ ELEVEN_LABS_API = ElevenLabs(base_url="https://api.elevenlabs.io", api_key=_api_
 
 MODEL_ID = "scribe_v1"
 
+# Audio files are handed to the SDK as open files and read in chunks this size
+UPLOAD_BUFFER_SIZE = 128 * 1024
+
 VOICE_ID = {
     "CN_FEMALE": "9lHjugDhwqoxA5MhX0az",  # Anna Su
     "SG_FEMALE": "SDNKIYEpTz0h56jQX8rA",  # Anthea
 }
 
 
-def text_to_speech(text, voice_id=VOICE_ID["SG_FEMALE"]):
-    return ELEVEN_LABS_API.text_to_speech.convert(
-        voice_id=voice_id,
-        output_format="mp3_44100_128",
-        text=text,
-        model_id="eleven_multilingual_v2",
-        voice_settings=VoiceSettings(speed=0.89),
-    )
+# Arguments shared by every call, bound once
+_TTS_CONVERT = partial(
+    ELEVEN_LABS_API.text_to_speech.convert,
+    output_format="mp3_44100_128",
+    model_id="eleven_multilingual_v2",
+    voice_settings=VoiceSettings(speed=0.89),
+)
 
+_STT_CONVERT = partial(
+    ELEVEN_LABS_API.speech_to_text.convert,
+    model_id=MODEL_ID,
+    tag_audio_events=False,
+    diarize=True,
+)
 
-def single_speaker_transcribe_stream(file: IO[bytes]):
-    ret = ELEVEN_LABS_API.speech_to_text.convert(
-        model_id=MODEL_ID,
-        num_speakers=1,
-        tag_audio_events=False,
-        diarize=True,
-        file=file,
-    )
 
-    return ret.text
+def text_to_speech(text, voice_id=VOICE_ID["SG_FEMALE"]):
+    return _TTS_CONVERT(voice_id=voice_id, text=text)
 
 
-def single_speaker_transcribe_file(file: str):
-    assert os.path.exists(file)
+def single_speaker_transcribe_stream(file: IO[bytes]):
+    return _STT_CONVERT(num_speakers=1, file=file).text
 
-    with open(file, "rb") as f:
-        ret = ELEVEN_LABS_API.speech_to_text.convert(
-            model_id=MODEL_ID,
-            num_speakers=1,
-            tag_audio_events=False,
-            diarize=True,
-            file=f,
-        )
 
-    return ret.text
+def single_speaker_transcribe_file(file: str):
+    with open(file, "rb", buffering=UPLOAD_BUFFER_SIZE) as f:
+        return _STT_CONVERT(num_speakers=1, file=f).text
 
 
 def multi_speaker_transcribe_file(file: str):
-    assert os.path.exists(file)
-
-    with open(file, "rb") as f:
-        ret = ELEVEN_LABS_API.speech_to_text.convert(
-            model_id=MODEL_ID,
-            num_speakers=3,
-            tag_audio_events=False,
-            diarize=True,
-            file=f,
-        )
-
-    words = ret.words
-
-    results = []
-
-    for g, ws in groupby(words, key=lambda ww: ww.speaker_id):
-        results.append({"speaker": g, "content": "".join([w.text for w in ws])})
+    with open(file, "rb", buffering=UPLOAD_BUFFER_SIZE) as f:
+        ret = _STT_CONVERT(num_speakers=3, file=f)
 
-    return results
+    return [
+        {"speaker": g, "content": "".join(w.text for w in ws)}
+        for g, ws in groupby(ret.words, key=attrgetter("speaker_id"))
+    ]
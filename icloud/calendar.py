@@ -1,4 +1,5 @@
 import logging
+import threading
 
 from enum import StrEnum, Enum
 
@@ -13,8 +14,8 @@ from EventKit import (
 )
 from Foundation import NSDate  # type: ignore
 
-from datetime import date, datetime, time as dt_time, timedelta
-from time import sleep, time
+from functools import cache, wraps
+from datetime import date, datetime, timedelta
 
 logger = logging.getLogger()
 
@@ -25,58 +26,123 @@ class NotProvided:
 
 NOT_PROVIDED = NotProvided()
 
-store = EKEventStore()
+EVENTS_HEADER = "| Event ID | Date | Name | Notes |\n|------|------|-----|-----|\n"
 
-CALENDARS = list(store.calendarsForEntityType_(EKEntityTypeEvent))
-REMINDERS = list(store.calendarsForEntityType_(EKEntityTypeReminder))
+REMINDERS_HEADER = "| Reminder ID | Title | Date |\n|------|------|-----|\n"
 
-assert CALENDARS, "Unable to load calendars"
+# The event store and calendars are looked up on first use rather than at
+# import, so importing this module does not hit EventKit. Tools run in worker
+# threads, so the lookups are serialized: two first calls racing could each
+# build an EKEventStore and mix objects from both.
+_LOOKUP_LOCK = threading.RLock()
 
 
-for _c in CALENDARS:
-    logger.info(f"Found calendar: {_c.title()} ({_c.UUID()})")
-logger.info(f"Found {len(CALENDARS)} calendar")
+def _cached(fn):
+    cached = cache(fn)
 
+    @wraps(fn)
+    def wrapper():
+        with _LOOKUP_LOCK:
+            return cached()
+
+    return wrapper
+
+
+@_cached
+def _store():
+    return EKEventStore()
+
+
+@_cached
+def _calendars():
+    calendars = list(_store().calendarsForEntityType_(EKEntityTypeEvent))
+
+    assert calendars, "Unable to load calendars"
+
+    for _c in calendars:
+        logger.info(f"Found calendar: {_c.title()} ({_c.UUID()})")
+    logger.info(f"Found {len(calendars)} calendar")
+
+    return calendars
+
+
+@_cached
+def _reminders():
+    reminders = list(_store().calendarsForEntityType_(EKEntityTypeReminder))
+
+    for _c in reminders:
+        logger.info(f"Found reminder: {_c.title()} ({_c.UUID()})")
+    logger.info(f"Found {len(reminders)} calendar")
+
+    return reminders
+
+
+def _by_name(calendars):
+    """Lowercased title -> calendar; the first of any duplicate titles wins"""
+    by_name = {}
+    for cal in calendars:
+        by_name.setdefault(cal.title().lower(), cal)
+    return by_name
+
+
+@_cached
+def _event_cal_by_name():
+    return _by_name(_calendars())
+
+
+@_cached
+def _reminder_cal_by_name():
+    return _by_name(_reminders())
 
-for _c in REMINDERS:
-    logger.info(f"Found reminder: {_c.title()} ({_c.UUID()})")
-logger.info(f"Found {len(REMINDERS)} calendar")
 
 # Events
-EVENT_CALENDAR = [cal for cal in CALENDARS if cal.title().lower() == "events"][0]
+@_cached
+def event_calendar():
+    return _event_cal_by_name()["events"]
+
 
 # G L
-ACTIVITIES_CALENDAR = [
-    cal
-    for cal in CALENDARS
-    if (cal.title().lower()[0] == "g" and cal.title().lower()[-1] == "l")
-][0]
+@_cached
+def activities_calendar():
+    return next(
+        cal
+        for cal in _calendars()
+        if (cal.title().lower()[0] == "g" and cal.title().lower()[-1] == "l")
+    )
+
 
 # Reminders
-TODO_CALENDAR = [cal for cal in REMINDERS if cal.title().lower() == "todo"][0]
+@_cached
+def todo_calendar():
+    return _reminder_cal_by_name()["todo"]
 
 
 class ResultCompletion:
+    """
+    Collects what an EventKit block is called with. The block may fire more
+    than once (once per event when enumerating), so every call's arguments
+    are accumulated; wait() returns after the first.
+    """
+
     def __init__(self):
-        self.completed = False
         self.args = []
         self.kwargs = {}
-        self.callback_wrapper = None
+        # Set by the callback, so wait() wakes as soon as EventKit answers
+        self._done = threading.Event()
+
+    @property
+    def completed(self):
+        return self._done.is_set()
 
     def __call__(self, *args, **kwargs):
         self.args.extend(args)
         self.kwargs.update(kwargs)
-        self.completed = True
+        self._done.set()
 
     def wait(self, timeout=1, no_raise=False):  # 1 second
-        time_threshold = (time() + timeout) if timeout > 0 else 9_999_999_999
-        while not self.completed:
-            sleep(0.1)
-            if time() >= time_threshold:
-                if no_raise:
-                    break
-                else:
-                    raise RuntimeError()
+        if not self._done.wait(timeout if timeout > 0 else None):
+            if not no_raise:
+                raise RuntimeError()
 
     def wait_args(self, idx=None, *, timeout=1, no_raise=False):
         self.wait(timeout=timeout, no_raise=no_raise)
@@ -88,22 +154,26 @@ class ResultCompletion:
         if self.completed:
             raise RuntimeError("Already completed")
 
+        # A plain function, which PyObjC converts to a block
         def f(*args, **kwargs):
             self(*args, **kwargs)
 
-        self.callback_wrapper = f
-
         return f
 
 
+# Dates are converted at local midnight using the offset at import, which is
+# exact for Asia/Singapore (no daylight saving)
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_LOCAL_UTC_OFFSET = datetime.now().astimezone().utcoffset().total_seconds()
+
+
 def to_nsdate(d):
     if isinstance(d, datetime):
-        ts = d.timestamp()
-        return NSDate().initWithTimeIntervalSince1970_(ts)
+        return NSDate.dateWithTimeIntervalSince1970_(d.timestamp())
 
     if isinstance(d, date):
-        ts = datetime.combine(d, dt_time()).timestamp()
-        return NSDate().initWithTimeIntervalSince1970_(ts)
+        ts = (d.toordinal() - _EPOCH_ORDINAL) * 86400 - _LOCAL_UTC_OFFSET
+        return NSDate.dateWithTimeIntervalSince1970_(ts)
 
 
 def to_pytdatetime(tagged_date):
@@ -122,12 +192,8 @@ def query_calendar_for_event(
     if isinstance(cal, list):
         cals = cal
     elif isinstance(cal, str):
-        cals = []
-        all_cals = store.calendarsForEntityType_(EKEntityTypeEvent)
-        for c in all_cals:
-            if c.title().lower() == cal.lower():
-                cals.append(c)
-                break
+        match = _event_cal_by_name().get(cal.lower())
+        cals = [] if match is None else [match]
     else:
         cals = [cal]
 
@@ -136,12 +202,12 @@ def query_calendar_for_event(
 
     rc = ResultCompletion()
 
-    p = store.predicateForEventsWithStartDate_endDate_calendars_(
+    p = _store().predicateForEventsWithStartDate_endDate_calendars_(
         to_nsdate(date.today()),
         to_nsdate(date.today() + timedelta(days=look_forward)),
         cals,
     )
-    store.enumerateEventsMatchingPredicate_usingBlock_(p, rc.callback())
+    _store().enumerateEventsMatchingPredicate_usingBlock_(p, rc.callback())
 
     events = rc.wait_args(no_raise=True)
 
@@ -152,80 +218,67 @@ def query_events(
     start_date: str, end_date: str, calendar_name: str = None, return_object=False
 ):
     if calendar_name == "EVENTS":
-        calendar = [EVENT_CALENDAR]
+        calendar = [event_calendar()]
     elif calendar_name == "ACTIVITIES":
-        calendar = [ACTIVITIES_CALENDAR]
+        calendar = [activities_calendar()]
     else:
-        calendar = [ACTIVITIES_CALENDAR, EVENT_CALENDAR]
+        calendar = [activities_calendar(), event_calendar()]
 
     start = datetime.fromisoformat(start_date).date()
     end = datetime.fromisoformat(end_date).date()
 
     rc = ResultCompletion()
 
-    p = store.predicateForEventsWithStartDate_endDate_calendars_(
+    p = _store().predicateForEventsWithStartDate_endDate_calendars_(
         to_nsdate(start),
         to_nsdate(end),
         calendar,
     )
-    store.enumerateEventsMatchingPredicate_usingBlock_(p, rc.callback())
+    _store().enumerateEventsMatchingPredicate_usingBlock_(p, rc.callback())
 
     events = rc.wait_args()
 
     if return_object:
         return events
 
-    ret = f"""
-| Event ID | Date | Name | Notes |
-|------|------|-----|
-"""
-
-    results = [
+    return EVENTS_HEADER + "\n".join(
         f"| {e.calendarItemIdentifier()} | {to_pydate(e.startDate())} | {e.title()} | {e.displayNotes() or ''} |"
         for e in events
-    ]
+    )
+
 
-    ret += "\n".join(results)
+_FAR_FUTURE = date(2999, 12, 31)
 
-    return ret
+
+def _reminder_row(e):
+    due = e.dueDate()
+    return (
+        None if due is None else to_pydate(due),
+        e.calendarItemIdentifier(),
+        e.title(),
+    )
 
 
 def query_reminders(return_obj=False):
-    pred = store.predicateForIncompleteRemindersWithDueDateStarting_ending_calendars_(
-        None, None, [TODO_CALENDAR]
+    pred = (
+        _store().predicateForIncompleteRemindersWithDueDateStarting_ending_calendars_(
+            None, None, [todo_calendar()]
+        )
     )
     # pred = store.predicateForRemindersInCalendars_([Reminders.TODO.value])
 
-    events = store.remindersMatchingPredicate_(pred)
-
-    values = sorted(
-        [
-            (
-                None if e.dueDate() is None else to_pydate(e.dueDate()),
-                e.calendarItemIdentifier(),
-                e.title(),
-            )
-            for e in events
-        ],
-        key=lambda v: (v[0] or date(2999, 12, 31)),
-    )
+    events = _store().remindersMatchingPredicate_(pred)
+
+    # Reminders without a due date sort last
+    values = sorted(map(_reminder_row, events), key=lambda v: v[0] or _FAR_FUTURE)
 
     if return_obj:
         return values
 
-    results = [
+    return REMINDERS_HEADER + "\n".join(
         f"| {v[1]} | {v[2]} | {'' if v[0] is None else v[0].isoformat()} |"
         for v in values
-    ]
-
-    ret = f"""
-| Reminder ID | Date | Title |
-|------|------|-----|
-"""
-
-    ret += "\n".join(results)
-
-    return ret
+    )
 
 
 def update_event(
@@ -237,7 +290,7 @@ def update_event(
     is_all_day: bool = NOT_PROVIDED,
     calendar_name: str = NOT_PROVIDED,
 ):
-    event = store.eventWithIdentifier_(uuid)
+    event = _store().eventWithIdentifier_(uuid)
     if not event:
         return f"No event with UUID: {uuid}"
 
@@ -260,11 +313,11 @@ def update_event(
 
     if calendar_name is not NOT_PROVIDED:
         if calendar_name == "EVENTS":
-            event.setCalendar_(EVENT_CALENDAR)
+            event.setCalendar_(event_calendar())
         elif calendar_name == "ACIVITIES":
-            event.setCalendar_(ACTIVITIES_CALENDAR)
+            event.setCalendar_(activities_calendar())
 
-    store.saveEvent_span_error_(event, True, None)
+    _store().saveEvent_span_error_(event, True, None)
 
     return "DONE"
 
@@ -279,13 +332,13 @@ def create_event(
     return_object=False,
 ):
     if calendar_name == "EVENTS":
-        calendar = EVENT_CALENDAR
+        calendar = event_calendar()
     elif calendar_name == "ACTIVITIES":
-        calendar = ACTIVITIES_CALENDAR
+        calendar = activities_calendar()
     else:
         return f"calendar_name must be one of ['EVENTS', 'ACTIVITIES']"
 
-    event = EKEvent().initWithEventStore_(store)
+    event = EKEvent().initWithEventStore_(_store())
 
     start = datetime.fromisoformat(start_datetime)
     end = (
@@ -305,7 +358,7 @@ def create_event(
     if notes:
         event.setDisplayNotes_(str(notes))
 
-    store.saveEvent_span_error_(event, True, None)
+    _store().saveEvent_span_error_(event, True, None)
 
     if return_object:
         return event
@@ -319,7 +372,7 @@ def update_reminder(
     title: str = NOT_PROVIDED,
     notes: str = NOT_PROVIDED,
 ):
-    reminder = store.reminderWithIdentifier_(uuid)
+    reminder = _store().reminderWithIdentifier_(uuid)
 
     if due_date is not NOT_PROVIDED:
         dt = datetime.fromisoformat(due_date)
@@ -331,7 +384,7 @@ def update_reminder(
     if notes is not NOT_PROVIDED:
         reminder.setDisplayNotes_(notes)
 
-    store.saveReminder_commit_error_(reminder, True, None)
+    _store().saveReminder_commit_error_(reminder, True, None)
 
     return "DONE"
 
@@ -341,7 +394,7 @@ def create_reminder(
     due_date: str = None,
     notes: str = None,
 ):
-    r = EKReminder.reminderWithEventStore_(store)
+    r = EKReminder.reminderWithEventStore_(_store())
 
     r.setTitle_(title)
 
@@ -352,24 +405,30 @@ def create_reminder(
     if notes:
         r.setDisplayNotes_(notes)
 
-    r.setCalendar_(TODO_CALENDAR)
+    r.setCalendar_(todo_calendar())
 
-    store.saveReminder_commit_error_(r, True, None)
+    _store().saveReminder_commit_error_(r, True, None)
 
     return f"DONE, Reminder UUID: {r.calendarItemIdentifier()}"
 
 
 def add_pay_rent():
-    cals = store.calendarsForEntityType_(EKEntityTypeReminder)
-    for cal in cals:
-        if cal.title() == "Todo":
-            break
-
-    pred = store.predicateForRemindersInCalendars_([cal])
-    events = store.remindersMatchingPredicate_(pred)
+    cal = todo_calendar()
+
+    # Only incomplete reminders due from the start of this month to the next
+    # one's are fetched, instead of the calendar's whole history
+    today = date.today()
+    pred = (
+        _store().predicateForIncompleteRemindersWithDueDateStarting_ending_calendars_(
+            to_nsdate(today.replace(day=1)),
+            to_nsdate(today + timedelta(days=40)),
+            [cal],
+        )
+    )
+    events = _store().remindersMatchingPredicate_(pred)
 
     for e in events:
-        if e.title() == "Pay Rent" and e.completionDate() is None:
+        if e.title() == "Pay Rent":
             dd = to_pydate(e.dueDate())
             if dd.day > 10:
                 print(e)
@@ -383,7 +442,7 @@ def add_pay_rent():
                     final_date = d2 + timedelta(days=5 - wk)
 
                 e.setDueDate_(to_nsdate(final_date))
-                store.saveReminder_commit_error_(e, True, None)
+                _store().saveReminder_commit_error_(e, True, None)
 
 
 if __name__ == "__main__":
@@ -417,15 +476,23 @@ if __name__ == "__main__":
     #     (datetime(2026, 12, 25), "Christmas Day"),
     # ]
 
-    # for start_date, desc in dates:
+    # Each create_event builds its own EKEvent and the store serializes the
+    # saves, so the events can be created concurrently
+    # from concurrent.futures import ThreadPoolExecutor
+    #
+    # def _create(entry):
+    #     start_date, desc = entry
     #     print(desc)
-    #     create_event(
+    #     return create_event(
+    #         "ACTIVITIES",
     #         desc,
     #         start_date.isoformat(),
     #         is_all_day=False,
-    #         cal=Calendars.ALEX.value,
-    #         notes=Tag.SCHOOL_HOLIDAY.value,
+    #         notes="SCHOOL_HOLIDAY",
     #     )
+    #
+    # with ThreadPoolExecutor(max_workers=8) as ex:
+    #     list(ex.map(_create, dates))
 
 
 # if False:
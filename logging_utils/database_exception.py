@@ -1,7 +1,10 @@
+import atexit
 import json
 import logging
 import os
+import queue
 import sqlite3
+import threading
 import traceback
 
 
@@ -11,6 +14,38 @@ from datetime import datetime
 DATA_PATH = os.environ["DB_PATH"]
 DB_PATH = os.path.join(DATA_PATH, "error.db")
 
+_INSERT_SQL = """
+INSERT INTO error (timestamp, action_id, action_data, error_log) VALUES (?, ?, ?, ?);
+"""
+
+# One connection per thread, opened on first use and kept for the process.
+# Each is also tracked so they can all be closed at exit.
+_tls = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+
+def _conn() -> sqlite3.Connection:
+    con = getattr(_tls, "con", None)
+    if con is None:
+        # Autocommit; check_same_thread is off only so _close_connections can
+        # close it from the exiting thread
+        con = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        _tls.con = con
+        with _connections_lock:
+            _connections.append(con)
+    return con
+
+
+@atexit.register
+def _close_connections():
+    with _connections_lock:
+        for con in _connections:
+            con.close()
+        _connections.clear()
+
 
 def _write_to_database(
     reference: str, error_log: str, timestamp: str = None, additional_data: dict = None
@@ -25,20 +60,81 @@ def _write_to_database(
     else:
         additional_data = ""
 
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute(
-            """
-            INSERT INTO error (timestamp, action_id, action_data, error_log) VALUES (?, ?, ?, ?);
-            """,
-            (
-                timestamp,
-                reference,
-                additional_data,
-                error_log,
-            ),
-        )
-        return cur.rowcount
+    cur = _conn().execute(
+        _INSERT_SQL,
+        (
+            timestamp,
+            reference,
+            additional_data,
+            error_log,
+        ),
+    )
+    return cur.rowcount
+
+
+# Rows queued by DatabaseExceptionHandler and written in batches by a
+# background thread, so the thread that logged never waits on the disk
+_write_queue = queue.SimpleQueue()
+_writer = None
+_writer_lock = threading.Lock()
+_STOP = None
+
+# Report the first failed write and then every this many
+FAILURE_REPORT_EVERY = 100
+
+
+def _drain_write_queue():
+    failures = 0
+    stopping = False
+    while not stopping:
+        rows = [_write_queue.get()]
+        try:
+            while True:
+                rows.append(_write_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        if _STOP in rows:
+            stopping = True
+            rows = [row for row in rows if row is not _STOP]
+        if not rows:
+            continue
+
+        try:
+            con = _conn()
+            con.execute("BEGIN")
+            try:
+                con.executemany(_INSERT_SQL, rows)
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+            con.execute("COMMIT")
+        except Exception as e:
+            # Fallback: print error if database write fails, but only every
+            # so often so a database that stays broken can't flood stderr
+            if failures % FAILURE_REPORT_EVERY == 0:
+                print(
+                    f"Failed to write {len(rows)} exception(s) to database "
+                    f"({failures + 1} failed batches so far): {e}"
+                )
+            failures += 1
+
+
+def _start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(
+                target=_drain_write_queue, name="error-db-writer", daemon=True
+            )
+            _writer.start()
+            # Registered after _close_connections, so it runs before it
+            atexit.register(_flush_writer)
+
+
+def _flush_writer():
+    _write_queue.put(_STOP)
+    _writer.join(timeout=5)
 
 
 class DatabaseExceptionHandler(logging.Handler):
@@ -48,6 +144,7 @@ class DatabaseExceptionHandler(logging.Handler):
 
     def __init__(self):
         super().__init__(logging.ERROR)
+        _start_writer()
 
     def emit(self, record):
         """
@@ -69,16 +166,17 @@ class DatabaseExceptionHandler(logging.Handler):
             # log_level = record.levelname  # 'ERROR', 'CRITICAL', etc.
             # log_level_num = record.levelno  # 40 for ERROR, 50 for CRITICAL, etc.
 
-            # Write to database
-            try:
-                _write_to_database(str(record.filename), tb_string, timestamp)
-            except Exception as e:
-                # Fallback: print error if database write fails
-                print(f"Failed to write exception to database: {e}")
+            # Queue for the background writer
+            _write_queue.put((timestamp, str(record.filename), "", tb_string))
 
 
 def with_database_exception_logging():
-    from .logging import LOGGER
+    from .default import LOGGER
+
+    # Without the database every write would fail; don't install the handler
+    if not os.path.exists(DB_PATH):
+        print(f"Error database not found, not logging exceptions to it: {DB_PATH}")
+        return
 
     # Add the custom database handler
     db_handler = DatabaseExceptionHandler()
@@ -1,5 +1,10 @@
+import atexit
 import logging
+import queue
 import sys
+import threading
+
+from logging.handlers import QueueHandler, QueueListener
 from typing import Callable
 
 
@@ -19,6 +24,28 @@ class FunctionHandler(logging.Handler):
 
 LOGGER = logging.getLogger()
 
+# Records are queued by the caller and written to the console on the
+# listener's thread, so console writes never block the logging code path (or
+# an event loop running it)
+_QUEUE = queue.SimpleQueue()
+_LISTENER = QueueListener(_QUEUE, respect_handler_level=True)
+_LISTENER_LOCK = threading.Lock()
+_listener_started = False
+
+
+def _add_queued_handler(handler: logging.Handler):
+    """Handle records on the listener's thread, starting it on first use"""
+    global _listener_started
+
+    with _LISTENER_LOCK:
+        if not _listener_started:
+            LOGGER.addHandler(QueueHandler(_QUEUE))
+            _LISTENER.start()
+            atexit.register(_LISTENER.stop)
+            _listener_started = True
+
+        _LISTENER.handlers = (*_LISTENER.handlers, handler)
+
 
 def setup_basic_logging():
     # Set up logger with custom handler
@@ -32,7 +59,7 @@ def setup_basic_logging():
         )
     )
 
-    LOGGER.addHandler(console_handler)
+    _add_queued_handler(console_handler)
     return LOGGER
 
 
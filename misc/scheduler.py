@@ -15,22 +15,35 @@ class Singleton(type):
 
 class Scheduler(metaclass=Singleton):
     def __init__(self):
-        self._scheduler = sched.scheduler(time.time, time.sleep)
+        # Set whenever the queue changes. The runner blocks on it while the
+        # queue is empty, and it cuts short the wait for the next task so a
+        # newly scheduled earlier task is not held up behind it.
+        self._wakeup = threading.Event()
+        self._scheduler = sched.scheduler(time.time, self._delay)
         self._runner = threading.Thread(target=self.loop, daemon=True)
         self._runner.start()
 
+    def _delay(self, seconds):
+        if self._wakeup.wait(seconds):
+            self._wakeup.clear()
+
     def loop(self):
         s = self._scheduler
         while True:
             s.run()
+            self._wakeup.wait()
+            self._wakeup.clear()
 
     def schedule(self, delay_in_seconds, func, *, args=(), kwargs={}):
-        return self._scheduler.enter(
+        event = self._scheduler.enter(
             delay_in_seconds, 1, func, argument=args, kwargs=kwargs
         )
+        self._wakeup.set()
+        return event
 
     def cancel(self, event):
         self._scheduler.cancel(event)
+        self._wakeup.set()
 
 
 class TaskManager(metaclass=Singleton):
@@ -1,13 +1,30 @@
 import os
 import time
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Literal
+from urllib3.util.retry import Retry
 
 _api_key = os.environ.get("REPLICATE_API_TOKEN")
 
 BASE_URL = "https://api.replicate.com/v1"
 FLUX_MODEL = "black-forest-labs/flux-2-pro"
 
+# Transient failures on GETs (polling, downloads) are retried with backoff.
+# POSTs are left alone: a retried create could start a second, billed
+# prediction.
+RETRY = Retry(
+    total=3,
+    backoff_factor=0.2,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["GET"]),
+    # Hand back the last response once retries run out, so the status checks
+    # below still raise ReplicateError with its status and body
+    raise_on_status=False,
+)
+
+DOWNLOAD_CHUNK_SIZE = 128 * 1024
+
 
 class ReplicateError(Exception):
     pass
@@ -19,6 +36,10 @@ class ReplicateClient:
         if not self.api_key:
             raise ValueError("REPLICATE_API_TOKEN environment variable not set")
         self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=RETRY),
+        )
         self.session.headers.update(
             {
                 "Authorization": f"Bearer {self.api_key}",
@@ -69,10 +90,20 @@ class ReplicateClient:
         return self._get(url)
 
     def wait_for_prediction(
-        self, prediction_id: str, *, poll_interval: float = 1.0, timeout: float = 300
+        self,
+        prediction_id: str,
+        *,
+        poll_interval: float = 0.2,
+        max_poll_interval: float = 5.0,
+        timeout: float = 300,
     ) -> dict:
-        """Poll a prediction until it completes or fails."""
+        """
+        Poll a prediction until it completes or fails. The first poll comes
+        quickly to catch short jobs, then the interval grows by half each
+        time up to max_poll_interval.
+        """
         start = time.time()
+        interval = poll_interval
         while True:
             prediction = self.get_prediction(prediction_id)
             status = prediction.get("status")
@@ -86,7 +117,8 @@ class ReplicateClient:
             if time.time() - start > timeout:
                 raise ReplicateError(f"Prediction timed out after {timeout}s")
 
-            time.sleep(poll_interval)
+            time.sleep(min(interval, max_poll_interval))
+            interval *= 1.5
 
     def generate_image(
         self,
@@ -98,7 +130,8 @@ class ReplicateClient:
         input_images: list = None,
         output_format: Literal["png", "jpg", "webp"] = "png",
         safety_tolerance: int = 2,
-        poll_interval: float = 1.0,
+        poll_interval: float = 0.2,
+        max_poll_interval: float = 5.0,
         timeout: float = 300,
     ) -> str:
         """Generate an image and wait for completion. Returns the output URL."""
@@ -114,7 +147,10 @@ class ReplicateClient:
 
         prediction_id = prediction["id"]
         result = self.wait_for_prediction(
-            prediction_id, poll_interval=poll_interval, timeout=timeout
+            prediction_id,
+            poll_interval=poll_interval,
+            max_poll_interval=max_poll_interval,
+            timeout=timeout,
         )
 
         output = result.get("output")
@@ -124,11 +160,16 @@ class ReplicateClient:
 
     def download_image(self, url: str, target_path: str) -> None:
         """Download an image from a URL to a local file."""
-        r = requests.get(url, timeout=120)
-        if r.status_code != 200:
-            raise ReplicateError(f"Failed to download image: {r.status_code}")
-        with open(target_path, "wb") as f:
-            f.write(r.content)
+        # Reuse the pooled connection, but don't send the API token to the
+        # file host
+        with self.session.get(
+            url, headers={"Authorization": None}, stream=True, timeout=120
+        ) as r:
+            if r.status_code != 200:
+                raise ReplicateError(f"Failed to download image: {r.status_code}")
+            with open(target_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
 
 
 REPLICATE_API = ReplicateClient()
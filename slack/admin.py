@@ -1,12 +1,28 @@
 import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 from slack_bolt import App
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
 from slack_sdk.web.client import WebClient
 from .constants import ADMIN_CHANNEL as ADMIN_CHANNEL_ID
 
+# Web API calls that hit a rate limit are retried after Slack's Retry-After
+RATE_LIMIT_RETRIES = 3
+
 APP = App(
     token=os.environ["SLACK_ADMIN_BOT_TOKEN"],
 )
+APP.client.retry_handlers.append(
+    RateLimitErrorRetryHandler(max_retry_count=RATE_LIMIT_RETRIES)
+)
+
+# Concurrent chat_delete calls when tearing down a thread
+DELETE_WORKERS = 5
+
+# Messages fetched per poll while waiting for a reply
+REPLY_PAGE_SIZE = 50
 
 
 class ChannelMessage:
@@ -80,21 +96,49 @@ class ChannelMessage:
             channel=self.channel_id, ts=thread_ts
         )
 
-        for reply in replies.data("messages", []):
-            if reply.get("subtype") == "tombstone":
-                continue
-            self._slack_client.chat_delete(channel=self.channel_id, ts=reply.get("ts"))
+        targets = [
+            reply.get("ts")
+            for reply in replies.data.get("messages", [])
+            if reply.get("subtype") != "tombstone"
+        ]
+
+        # Slack has no bulk delete, so the calls are issued concurrently
+        with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as ex:
+            list(
+                ex.map(
+                    lambda ts: self._slack_client.chat_delete(
+                        channel=self.channel_id, ts=ts
+                    ),
+                    targets,
+                )
+            )
 
     def wait_for_reply(self, sent_response):
         assert sent_response, f"Response is not ok"
         ts = sent_response
 
-        for _ in range(self._timeout_seconds * 2):
-            for p in self._slack_client.conversations_replies(
-                channel=self.channel_id, ts=ts, limit=1
-            ):
-                if len(p.data["messages"]) > 1:
-                    return p.data["messages"][-1].get("text", "")
+        # Poll with a growing delay. Each poll only asks for messages newer
+        # than the prompt, and the thread parent is skipped if Slack includes
+        # it anyway. If several replies arrived since the last poll, the
+        # latest one is returned.
+        deadline = time.time() + self._timeout_seconds
+        delay = 0.5
+        while time.time() < deadline:
+            resp = self._slack_client.conversations_replies(
+                channel=self.channel_id,
+                ts=ts,
+                oldest=ts,
+                inclusive=False,
+                limit=REPLY_PAGE_SIZE,
+            )
+            replies = [
+                m for m in resp.data.get("messages", []) if float(m["ts"]) > float(ts)
+            ]
+            if replies:
+                return max(replies, key=lambda m: float(m["ts"])).get("text", "")
+
+            time.sleep(min(delay, max(deadline - time.time(), 0)))
+            delay = min(delay * 1.5, 5.0)
 
         return None
 
@@ -1,14 +1,61 @@
 from typing import IO, Optional
-import base64
+import binascii
 import os
 import requests
+import tempfile
+import time
 
-from io import BytesIO
+from claude.media import claude_image_block_from_bytes
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
 from slack_bolt import App
 from slack_sdk.web.client import WebClient
+from urllib3.util.retry import Retry
 
 BOT_USER_ID = "U04BDAUG6PQ"
 
+DOWNLOAD_TIMEOUT = 30
+
+# Concurrent downloads for a message with several attachments; within the
+# session's per-host pool, so none wait for a connection
+DOWNLOAD_WORKERS = 8
+
+# Read size when base64-encoding a download; a multiple of 3
+B64_CHUNK_SIZE = 57 * 1024
+
+# Audio downloads stay in memory up to this size and spill to disk beyond it
+AUDIO_SPOOL_SIZE = 8 * 1024 * 1024
+AUDIO_CHUNK_SIZE = 64 * 1024
+
+# Concurrent conversations_replies calls when reading several threads at once
+THREAD_WORKERS = 8
+
+# Replies read per conversations_replies call, and the most pages read when
+# looking for a thread's metadata
+THREAD_PAGE_SIZE = 200
+THREAD_MAX_PAGES = 5
+
+# File downloads share pooled keep-alive connections to files.slack.com and
+# retry transient failures with exponential backoff, waiting out Slack's
+# Retry-After on 429. Every request carries the bot's token.
+_SESSION = requests.Session()
+_SESSION.headers["Authorization"] = f"Bearer {os.environ['SLACK_BOT_TOKEN']}"
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+        ),
+    ),
+)
+
 
 def send_message_with_metadata(
     client: WebClient,
@@ -60,65 +107,142 @@ def fetch_latest_metadata_from_thread(
     if isinstance(event_fields, str):
         event_fields = [event_fields]
 
+    # Checked as a subset of the payload's keys; empty matches any payload
+    fields = frozenset(event_fields or ())
+
+    for msg in _iter_thread_messages_newest_first(client, channel, ts):
+        meta = msg.get("metadata")
+        if not meta:
+            continue
+
+        if event_type and meta.get("event_type") != event_type:
+            continue
+
+        payload = meta["event_payload"]
+        if payload.keys() >= fields:
+            return payload
+
+    return None
+
+
+def _iter_thread_messages_newest_first(client: WebClient, channel: str, ts: str):
+    """
+    Yield a thread's messages, with metadata, newest first. Slack pages
+    replies oldest first, so every page (up to THREAD_MAX_PAGES) is fetched
+    before the first yield; most threads fit in a single page.
+    """
+    pages = []
     cursor = None
-    for _ in range(5):
+    for _ in range(THREAD_MAX_PAGES):
         h = client.conversations_replies(
-            channel=channel, ts=ts, limit=4, include_all_metadata=True, cursor=cursor
+            channel=channel,
+            ts=ts,
+            limit=THREAD_PAGE_SIZE,
+            include_all_metadata=True,
+            cursor=cursor,
         )
 
-        has_more = h.data["has_more"]
-
         msgs = h.data["messages"]
-        msgs.reverse()
-
-        # conversations_replies always returns root msg
-        if has_more:
-            msgs = msgs[:-1]
+        # conversations_replies always returns root msg; keep it only once
+        if pages:
+            msgs = [m for m in msgs if m.get("ts") != ts]
+        pages.append(msgs)
 
-        for msg in h.data["messages"]:
-            meta = msg.get("metadata")
-            if meta:
-                if event_type and meta.get("event_type") != event_type:
-                    continue
+        if not h.data["has_more"]:
+            break
 
-                payload = meta["event_payload"]
+        cursor = h.data["response_metadata"]["next_cursor"]
 
-                if not event_fields:
-                    return payload
+    for msgs in reversed(pages):
+        yield from reversed(msgs)
 
-                for field in event_fields:
-                    if field not in payload:
-                        break
-                else:
-                    return payload
 
-        if not has_more:
-            return None
+def fetch_latest_metadata_from_threads(
+    client: WebClient,
+    channel: str,
+    thread_tss: list[str],
+    event_type: str = None,
+    event_fields: str | list[str] = None,
+) -> dict[str, Optional[dict]]:
+    """
+    fetch_latest_metadata_from_thread for several threads of a channel,
+    with the Slack calls made concurrently. Rate-limited calls are retried
+    by the client's own retry handlers, if it has any.
+    Returns:
+        dict[str, Optional[dict]]: The metadata found for each thread ts.
+    """
+    with ThreadPoolExecutor(max_workers=THREAD_WORKERS) as ex:
+        payloads = ex.map(
+            lambda ts: fetch_latest_metadata_from_thread(
+                client, channel, ts, event_type, event_fields
+            ),
+            thread_tss,
+        )
+        return dict(zip(thread_tss, payloads))
 
-        cursor = h.data["response_metadata"]["next_cursor"]
 
-    return None
+# Bot-uploaded files by name -> (file, time cached). Only hits are kept, since
+# a miss is followed by an upload that a later lookup must see. Entries expire
+# after BOT_FILE_CACHE_TTL seconds, so a file deleted on Slack is looked up
+# again, and the oldest go once there are BOT_FILE_CACHE_SIZE.
+BOT_FILE_CACHE_TTL = 300
+BOT_FILE_CACHE_SIZE = 256
+_bot_file_cache: dict[str, tuple[dict, float]] = {}
 
 
 def get_pdf_text_by_file_id(app: App, pdf_id: str) -> dict:
-    for f in app.client.files_list():
+    cached = _bot_file_cache.get(pdf_id)
+    if cached and time.monotonic() - cached[1] < BOT_FILE_CACHE_TTL:
+        return cached[0]
+
+    # The user filter runs server-side, so only the bot's own files are paged
+    for f in app.client.files_list(user=BOT_USER_ID, count=200):
         for ff in f["files"]:
-            if ff["user"] == BOT_USER_ID and ff["name"] == pdf_id:
+            if ff["name"] == pdf_id:
+                _bot_file_cache.pop(pdf_id, None)
+                if len(_bot_file_cache) >= BOT_FILE_CACHE_SIZE:
+                    del _bot_file_cache[next(iter(_bot_file_cache))]
+                _bot_file_cache[pdf_id] = (ff, time.monotonic())
                 return ff
     return None
 
 
+def _download_b64(file: dict) -> str:
+    """
+    Download a file and base64-encode it as it arrives, so the raw content
+    is never held in full. Chunks are encoded on 3-byte boundaries so no
+    padding lands mid-stream; a leftover tail is carried to the next chunk.
+    """
+    encoded = bytearray()
+    carry = b""
+
+    with _SESSION.get(
+        file["url_private_download"],
+        timeout=DOWNLOAD_TIMEOUT,
+        stream=True,
+    ) as r:
+        # An error page would otherwise be sent to Claude as the file
+        r.raise_for_status()
+
+        for chunk in r.iter_content(chunk_size=B64_CHUNK_SIZE):
+            chunk = carry + chunk
+            cut = len(chunk) - len(chunk) % 3
+            encoded += binascii.b2a_base64(chunk[:cut], newline=False)
+            carry = chunk[cut:]
+
+    encoded += binascii.b2a_base64(carry, newline=False)
+    return encoded.decode("ascii")
+
+
 def download_file(files_block):
+    # Attachments are fetched concurrently, then returned in order
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as ex:
+        contents = list(ex.map(_download_b64, files_block))
+
     file_msgs = []
 
-    for file in files_block:
+    for file, b64_str in zip(files_block, contents):
         media_type = file["mimetype"]
-        r = requests.get(
-            file["url_private_download"],
-            headers={"Authorization": f"Bearer {os.environ.get("SLACK_BOT_TOKEN")}"},
-        )
-        byte_content = r.content
-        b64_str = base64.b64encode(byte_content).decode()
 
         file_msgs.append(
             {
@@ -131,14 +255,26 @@ def download_file(files_block):
     return file_msgs
 
 
+class _NamedSpooledFile(tempfile.SpooledTemporaryFile):
+    # Upload clients take the file name from .name, which is read-only on
+    # SpooledTemporaryFile
+    name = None
+
+
 def extract_m4a_bio(m: dict) -> IO[bytes]:
     file = m["files"][0]
 
-    r = requests.get(
-        file["url_private_download"],
-        headers={"Authorization": f"Bearer {os.environ.get("SLACK_BOT_TOKEN")}"},
-    )
-    bio = BytesIO(r.content)
+    with _SESSION.get(
+        file["url_private_download"], timeout=DOWNLOAD_TIMEOUT, stream=True
+    ) as r:
+        # An error page would otherwise be returned as the audio
+        r.raise_for_status()
+
+        bio = _NamedSpooledFile(max_size=AUDIO_SPOOL_SIZE)
+        for chunk in r.iter_content(chunk_size=AUDIO_CHUNK_SIZE):
+            bio.write(chunk)
+
+    bio.seek(0)
     bio.name = "1.m4a"
 
     return bio
@@ -150,12 +286,7 @@ def extract_m4a_bio(m: dict) -> IO[bytes]:
 #     file = m["files"][0]
 #     text = get_pdf_text_by_file_id(app, file["id"])
 #     if not text:
-#         r = requests.get(
-#             file["url_private_download"],
-#             headers={"Authorization": f"Bearer {os.environ.get("SLACK_BOT_TOKEN")}"},
-#         )
-#         bio = BytesIO(r.content)
-#         bio.name = "1.m4a"
+#         bio = extract_m4a_bio(m)
 
 #         model = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 #         transcription = model.audio.transcriptions.create(model="whisper-1", file=bio)
@@ -163,10 +294,7 @@ def extract_m4a_bio(m: dict) -> IO[bytes]:
 
 #         app.client.files_upload_v2(filename=file["id"], content=file_content)
 #     else:
-#         r = requests.get(
-#             text["url_private_download"],
-#             headers={"Authorization": f"Bearer {os.environ.get("SLACK_BOT_TOKEN")}"},
-#         )
+#         r = _SESSION.get(text["url_private_download"], timeout=DOWNLOAD_TIMEOUT)
 #         file_content = r.content.decode("utf-8")
 #     return file_content
 
@@ -176,14 +304,25 @@ def fetch_single_message(client: WebClient, channel: str, msg_ts: str):
         channel=channel, latest=msg_ts, inclusive=True, limit=1
     )
 
-    for m in r:
-        for m in m["messages"]:
-            return m
+    msgs = r["messages"]
+    return msgs[0] if msgs else None
+
+
+# Slack files are immutable once uploaded, so a thread that is read again
+# reuses its attachments instead of downloading them again. Failed downloads
+# raise, so an error page is never cached as the file.
+@lru_cache(maxsize=32)
+def _download_file_bytes(file_id: str, url: str) -> bytes:
+    r = _SESSION.get(url, timeout=DOWNLOAD_TIMEOUT)
+    r.raise_for_status()
+    return r.content
 
-    return None
 
+def _download_bytes(file: dict) -> bytes:
+    return _download_file_bytes(file["id"], file["url_private_download"])
 
-def _parse_slack_msg_and_file(m: dict) -> list:
+
+def _parse_slack_msg_and_file(m: dict, downloads: dict[str, bytes]) -> list:
     files = m.get("files")
 
     if not files:
@@ -192,14 +331,7 @@ def _parse_slack_msg_and_file(m: dict) -> list:
     file = files[0]
     filetype = file["filetype"]
 
-    r = requests.get(
-        file["url_private_download"],
-        headers={"Authorization": f"Bearer {os.environ.get("SLACK_BOT_TOKEN")}"},
-    )
-
-    from claude.agent import claude_image_block_from_bytes
-
-    return claude_image_block_from_bytes(filetype, r.content)
+    return claude_image_block_from_bytes(filetype, downloads[file["id"]])
 
 
 def _parse_slack_msg(m: dict) -> list:
@@ -213,31 +345,67 @@ def _parse_slack_msg(m: dict) -> list:
 
 
 def get_history_by_thread_ts(app: App, channel: str, thread_ts: str) -> list:
-    msgs = app.client.conversations_replies(channel=channel, ts=thread_ts)["messages"]
+    msgs = []
+    for page in app.client.conversations_replies(
+        channel=channel, ts=thread_ts, limit=THREAD_PAGE_SIZE
+    ):
+        for m in page["messages"]:
+            # conversations_replies repeats the root msg on every page
+            if msgs and m["ts"] == thread_ts:
+                continue
+            msgs.append(m)
 
-    ret = []
+    # (message, is_file) for each entry; attachments come before the text
+    parts = []
     for m in msgs:
-        file_content = _parse_slack_msg_and_file(m)
-        if file_content:
-            ret.append(file_content)
+        if m.get("files"):
+            parts.append((m, True))
+        if m.get("text"):
+            parts.append((m, False))
+
+    # A trailing user entry is left out, so its attachment is never fetched
+    if parts and (parts[-1][1] or "bot_id" not in parts[-1][0]):
+        parts.pop()
 
-        content = _parse_slack_msg(m)
-        if content:
-            ret.append(content)
+    # Each message's first attachment is downloaded up front, concurrently
+    files = [m["files"][0] for m, is_file in parts if is_file]
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as ex:
+        downloads = dict(zip([f["id"] for f in files], ex.map(_download_bytes, files)))
 
-    if ret and ret[-1]["role"] == "user":
-        return ret[:-1]
+    return [
+        _parse_slack_msg_and_file(m, downloads) if is_file else _parse_slack_msg(m)
+        for m, is_file in parts
+    ]
 
-    return ret
+
+# Lowercased channel name -> id, refreshed by a full listing when a lookup
+# misses or the listing is older than CHANNEL_CACHE_TTL seconds
+CHANNEL_CACHE_TTL = 300
+_channel_cache: dict[str, str] = {}
+_channel_cache_ts = 0.0
 
 
 def get_channel_id_by_name(app: App, name: str) -> str:
+    global _channel_cache_ts
+
     name = name.lower()
-    for page in app.client.conversations_list():
+    if time.monotonic() - _channel_cache_ts < CHANNEL_CACHE_TTL:
+        channel_id = _channel_cache.get(name)
+        if channel_id:
+            return channel_id
+
+    channels = {}
+    for page in app.client.conversations_list(
+        limit=1000, exclude_archived=True, types="public_channel,private_channel"
+    ):
         for c in page["channels"]:
-            if c["name"].lower() == name:
-                return c["id"]
-    return
+            channels.setdefault(c["name"].lower(), c["id"])
+
+    _channel_cache.clear()
+    _channel_cache.update(channels)
+    _channel_cache_ts = time.monotonic()
+
+    return channels.get(name)
 
 
 def get_channel_history(app: App, channel_id: str):
@@ -248,9 +416,5 @@ def test():
     c = "C08BSGX1WDA"
     from slack.admin import APP
 
-    pages = get_channel_history(APP, c)
-    for page in pages:
-        for m in page["messages"]:
-            return m
-
-    return None
+    msgs = get_channel_history(APP, c)["messages"]
+    return msgs[0] if msgs else None